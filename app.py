@@ -15,15 +15,57 @@ DB_PATH = 'aml_data.db'
 def init_db():
     if 'db_initialized' not in st.session_state:
         import os
+        import db_setup
         if not os.path.exists(DB_PATH):
-            import db_setup
             db_setup.setup_database(DB_PATH)
+        else:
+            db_setup.actualizar_esquema(DB_PATH)
         st.session_state.db_initialized = True
 
-def get_connection():
-    return sqlite3.connect(DB_PATH)
+def get_connection(escritura=False):
+    # Lecturas desde el pool compartido; las escrituras esperan su turno en la conexión única.
+    # close() devuelve la conexión al administrador
+    if escritura:
+        return conexion_escritura(DB_PATH)
+    return conexion_lectura(DB_PATH)
+
+def mostrar_estadisticas_carga(stats):
+    if stats.get('filas'):
+        st.caption(f"Glosas: {stats['filas']:,} filas, {stats['glosas_unicas']:,} valores distintos "
+                   f"(ratio de deduplicación {stats['ratio_dedup']:.1f}x), "
+                   f"limpieza a {stats['filas_por_seg']:,.0f} filas/seg")
+    if stats.get('duplicados'):
+        st.warning(f"⚠️ {stats['duplicados']:,} transacciones ya existían en la base (omitidas o marcadas como duplicadas)")
+    if stats.get('filas_insertadas'):
+        st.caption(f"Inserción: {stats['filas_insertadas']:,} filas en {stats['segundos_insercion']:.1f} s "
+                   f"({stats['filas_por_seg_insercion']:,.0f} filas/seg)")
+
+@st.fragment(run_every=2)
+def mostrar_trabajos_carga():
+    conn = get_connection()
+    df_trabajos = obtener_trabajos_carga(conn)
+    
+    if df_trabajos.empty:
+        st.info("No hay trabajos de carga")
+    else:
+        activos = df_trabajos[df_trabajos['estado'].isin(['PENDIENTE', 'EN_CURSO'])]
+        for _, trabajo in activos.iterrows():
+            st.progress(min(float(trabajo['porcentaje'] or 0) / 100, 1.0),
+                        text=f"{trabajo['codigo_carga']} ({trabajo['estado']}): {int(trabajo['filas_procesadas'] or 0):,} registros"
+                             + (f", {trabajo['filas_por_seg']:,.0f} filas/seg" if pd.notna(trabajo['filas_por_seg']) else ""))
+        st.dataframe(df_trabajos, use_container_width=True)
+        
+        errores = df_trabajos[df_trabajos['estado'] == 'ERROR']['id_trabajo'].tolist()
+        if errores:
+            col_trabajo, col_boton = st.columns([3, 1])
+            id_trabajo = col_trabajo.selectbox("Trabajo con error", errores)
+            if col_boton.button("Reintentar"):
+                with transaccion_escritura(DB_PATH) as escritor:
+                    reintentar_trabajo(escritor, id_trabajo)
+    conn.close()
 
 init_db()
+iniciar_procesador_cargas(DB_PATH)
 
 st.sidebar.title("🔍 Sistema AML")
 
@@ -44,18 +86,22 @@ if menu == "Inicio":
     try:
         total_cargas = cursor.execute("SELECT COUNT(*) FROM cargas").fetchone()[0]
         total_casos = cursor.execute("SELECT COUNT(*) FROM casos").fetchone()[0]
-        total_transacciones = cursor.execute("SELECT COUNT(*) FROM transacciones").fetchone()[0]
+        # Totales del catálogo mantenido en la carga, sin recorrer transacciones
+        estadisticas = obtener_estadisticas_generales(conn)
         
         col1.metric("Cargas de Datos", total_cargas)
         col2.metric("Casos Activos", total_casos)
-        col3.metric("Transacciones Totales", f"{total_transacciones:,}")
+        col3.metric("Transacciones Totales", f"{estadisticas['filas']:,}")
+        if estadisticas['fecha_min']:
+            st.caption(f"Operaciones del {estadisticas['fecha_min']} al {estadisticas['fecha_max']} · "
+                       f"{estadisticas['filas'] - estadisticas['filas_unicas']:,} marcadas como duplicadas")
     except:
         st.warning("Base de datos vacía o no inicializada.")
     
     st.markdown("---")
     st.markdown("""
     ### Funcionalidades del Sistema
-    - 📊 **Cargar Datos**: Importar archivos Excel (.xlsx) con datos financieros masivos.
+    - 📊 **Cargar Datos**: Importar archivos Excel (.xlsx), CSV o Parquet con datos financieros masivos.
     - 📁 **Gestión de Casos**: Crear y administrar casos de investigación.
     - 🔬 **Análisis de Patrones**: Ejecutar análisis especializados de detección.
     - 📄 **Reportes PDF**: Generar informes ejecutivos profesionales.
@@ -66,37 +112,157 @@ if menu == "Inicio":
 elif menu == "Cargar Datos":
     st.title("📊 Carga de Datos")
     
-    st.markdown("### Importar Archivo Excel")
+    st.markdown("### Importar Archivo (Excel, CSV o Parquet)")
     
     codigo_carga = st.text_input("Código de Carga (identificador único)", 
                                   placeholder="Ej: CARGA_2024_001")
     
-    uploaded_file = st.file_uploader("Seleccionar archivo Excel", type=['xlsx'])
+    modo_paralelo = st.checkbox("Varios archivos u hojas en una misma carga (procesamiento paralelo)", value=False)
+    
+    if modo_paralelo:
+        uploaded_file = st.file_uploader("Seleccionar archivos", type=['xlsx', 'csv', 'parquet'], accept_multiple_files=True)
+        modo_streaming = True
+        modo_reanudable = False
+    else:
+        uploaded_file = st.file_uploader("Seleccionar archivo", type=['xlsx', 'csv', 'parquet'])
+        modo_streaming = st.checkbox("Lectura por bloques (memoria acotada, recomendado para archivos grandes)", value=True)
+        modo_reanudable = st.checkbox("Carga reanudable (confirma cada bloque; si se interrumpe, vuelva a cargar el mismo archivo con el mismo código)",
+                                      value=False, disabled=not modo_streaming)
+        modo_reanudable = modo_streaming and modo_reanudable
+    
+    col_masivo, col_indices = st.columns(2)
+    modo_masivo = col_masivo.checkbox("Inserción masiva (PRAGMAs de carga)", value=False)
+    reconstruir_indices = col_indices.checkbox("Reconstruir índices al finalizar (cargas muy grandes)", value=False,
+                                               disabled=not modo_masivo)
+    
+    modo_segundo_plano = st.checkbox("Procesar en segundo plano (sigue aunque se cierre la pestaña; se pueden encolar varias cargas)",
+                                     value=True)
+    if modo_segundo_plano and not modo_paralelo:
+        # La cola siempre usa la carga reanudable: un reinicio del servidor continúa desde el último bloque
+        modo_reanudable = True
+    
+    opciones_duplicados = {"Omitir duplicados": 'omitir', "Marcar duplicados": 'marcar', "No verificar": None}
+    modo_duplicados = opciones_duplicados[st.radio("Transacciones ya cargadas (cuenta, fecha, hora, secuencial, registro, monto)",
+                                                   list(opciones_duplicados), horizontal=True)]
     
     if uploaded_file and codigo_carga:
         if st.button("Cargar Datos", type="primary"):
             progress_text = "Iniciando proceso de carga..."
             my_bar = st.progress(0, text=progress_text)
             
+            # El escritor se toma recién al escribir: la consulta y la validación previa van por una lectura
+            conn = None
             try:
-                conn = get_connection()
-                cursor = conn.cursor()
-                existe = cursor.execute("SELECT id_carga FROM cargas WHERE codigo_carga = ?", 
-                                      (codigo_carga,)).fetchone()
+                lector = get_connection()
+                try:
+                    existe = lector.execute("SELECT id_carga, estado FROM cargas WHERE codigo_carga = ?", 
+                                            (codigo_carga,)).fetchone()
+                finally:
+                    lector.close()
                 
-                if existe:
-                    st.error("Este código de carga ya existe. Use otro código.")
+                # Validación previa (encabezado + muestra) antes de leer el archivo completo
+                archivos_validar = uploaded_file if modo_paralelo else [uploaded_file]
+                validaciones = [v for f in archivos_validar
+                                for v in validar_archivo(f, f.name, todas_las_hojas=modo_paralelo)]
+                errores_validacion = [v for v in validaciones if v['faltantes'] or v['problemas']]
+                
+                if existe and not (modo_reanudable and existe[1] == 'EN_PROCESO'):
+                    if existe[1] == 'EN_PROCESO':
+                        st.error("Esta carga quedó incompleta. Marque 'Carga reanudable' para continuarla.")
+                    else:
+                        st.error("Este código de carga ya existe. Use otro código.")
+                    my_bar.empty()
+                elif errores_validacion:
+                    for v in errores_validacion:
+                        unidad = describir_unidad((v['archivo'], v['hoja']))
+                        if v['faltantes']:
+                            st.error(f"{unidad}: columnas faltantes: {', '.join(v['faltantes'])}")
+                        for problema in v['problemas']:
+                            st.error(f"{unidad}: {problema}")
                     my_bar.empty()
+                elif modo_segundo_plano:
+                    st.caption(f"Validación previa correcta: ~{sum(v['filas_estimadas'] or 0 for v in validaciones):,} filas estimadas "
+                               f"({max(v['segundos'] for v in validaciones):.2f} s)")
+                    archivos = uploaded_file if modo_paralelo else [uploaded_file]
+                    try:
+                        with transaccion_escritura(DB_PATH) as escritor:
+                            id_trabajo = encolar_carga(escritor, DB_PATH, codigo_carga,
+                                                       [(f.name, f.getvalue()) for f in archivos],
+                                                       opciones={'masivo': modo_masivo,
+                                                                 'reconstruir_indices': modo_masivo and reconstruir_indices,
+                                                                 'modo_duplicados': modo_duplicados})
+                        my_bar.empty()
+                        st.success(f"✅ Carga encolada (trabajo {id_trabajo}). Puede seguir trabajando; el avance se muestra abajo.")
+                    except ValueError as e:
+                        st.error(str(e))
+                        my_bar.empty()
+                elif modo_paralelo:
+                    barras_archivo = {}
+                    
+                    def update_bar_archivo(clave, progreso, filas):
+                        if clave not in barras_archivo:
+                            barras_archivo[clave] = st.progress(0, text=describir_unidad(clave))
+                        barras_archivo[clave].progress(progreso, text=f"{describir_unidad(clave)}: {filas:,} registros ({int(progreso*100)}%)")
+                    
+                    try:
+                        stats_carga = {}
+                        my_bar.progress(0, text=f"Procesando {len(uploaded_file)} archivos en paralelo...")
+                        conn = get_connection(escritura=True)
+                        id_carga = cargar_archivos_paralelo([(f.name, f.getvalue()) for f in uploaded_file],
+                                                            codigo_carga, conn,
+                                                            progress_callback=update_bar_archivo,
+                                                            estadisticas=stats_carga,
+                                                            masivo=modo_masivo,
+                                                            reconstruir_indices=modo_masivo and reconstruir_indices,
+                                                            modo_duplicados=modo_duplicados)
+                        
+                        my_bar.progress(1.0, text="Finalizado!")
+                        st.success(f"✅ Datos cargados exitosamente. ID de carga: {id_carga}")
+                        mostrar_estadisticas_carga(stats_carga)
+                        st.balloons()
+                    except ValueError as e:
+                        st.error(str(e))
+                        my_bar.empty()
+                elif modo_streaming or tipo_archivo(uploaded_file.name) != 'xlsx':
+                    def update_bar_streaming(progreso, filas):
+                        my_bar.progress(progreso, text=f"Registros insertados: {filas:,} ({int(progreso*100)}%)")
+                    
+                    try:
+                        stats_carga = {}
+                        conn = get_connection(escritura=True)
+                        if modo_reanudable:
+                            if existe:
+                                st.info(f"Reanudando carga incompleta desde el registro {obtener_carga_pendiente(conn, codigo_carga)[1]:,}")
+                            id_carga = cargar_datos_reanudable(uploaded_file, codigo_carga, conn,
+                                                               progress_callback=update_bar_streaming,
+                                                               estadisticas=stats_carga,
+                                                               masivo=modo_masivo,
+                                                               modo_duplicados=modo_duplicados)
+                        else:
+                            id_carga = cargar_datos_streaming(uploaded_file, codigo_carga, conn,
+                                                              progress_callback=update_bar_streaming,
+                                                              estadisticas=stats_carga,
+                                                              masivo=modo_masivo,
+                                                              reconstruir_indices=modo_masivo and reconstruir_indices,
+                                                              modo_duplicados=modo_duplicados)
+                        
+                        my_bar.progress(1.0, text="Finalizado!")
+                        st.success(f"✅ Datos cargados exitosamente. ID de carga: {id_carga}")
+                        mostrar_estadisticas_carga(stats_carga)
+                        st.balloons()
+                        
+                        st.markdown("### Vista previa de datos")
+                        st.dataframe(pd.read_sql_query(
+                            "SELECT * FROM transacciones WHERE id_carga = ? LIMIT 10",
+                            conn, params=[id_carga]))
+                    except ValueError as e:
+                        st.error(str(e))
+                        my_bar.empty()
                 else:
                     with st.spinner("Leyendo archivo Excel (esto puede tomar unos minutos si el archivo es grande)..."):
                         df = pd.read_excel(uploaded_file, engine='openpyxl')
                     
-                    columnas_requeridas = [
-                        'CODUNICOCLI_13_enc', 'TIPO DE MARCA', 'DESTIPDOCUMENTO',
-                        'DESTIPBANCA', 'SEGMENTO', 'ACT.ECONOMICA', 'Fecha', 'Monto', 'I / E'
-                    ]
-                    
-                    faltantes = [col for col in columnas_requeridas if col not in df.columns]
+                    faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in df.columns]
                     
                     if faltantes:
                         st.error(f"Columnas faltantes: {', '.join(faltantes)}")
@@ -107,30 +273,100 @@ elif menu == "Cargar Datos":
                         def update_bar(progreso):
                             my_bar.progress(progreso, text=f"Insertando registros en base de datos: {int(progreso*100)}%")
                         
-                        id_carga = cargar_datos(df, codigo_carga, conn, progress_callback=update_bar)
+                        stats_carga = {}
+                        conn = get_connection(escritura=True)
+                        id_carga = cargar_datos(df, codigo_carga, conn, progress_callback=update_bar,
+                                                estadisticas=stats_carga, masivo=modo_masivo,
+                                                reconstruir_indices=modo_masivo and reconstruir_indices,
+                                                modo_duplicados=modo_duplicados)
                         
                         my_bar.progress(1.0, text="Finalizado!")
                         st.success(f"✅ Datos cargados exitosamente. ID de carga: {id_carga}")
+                        mostrar_estadisticas_carga(stats_carga)
                         st.balloons()
                         
                         st.markdown("### Vista previa de datos")
                         st.dataframe(df.head(10))
-                
-                conn.close()
                         
             except Exception as e:
                 my_bar.empty()
                 st.error(f"Error crítico al cargar datos: {str(e)}")
+            finally:
+                if conn is not None:
+                    conn.close()
     
     st.markdown("---")
+    st.markdown("### Trabajos de Carga")
+    mostrar_trabajos_carga()
+    
     st.markdown("### Cargas Existentes")
     
+    with st.expander("⚙️ Mantenimiento de almacenamiento"):
+        conn = get_connection()
+        if dimensiones_codificadas(conn):
+            st.info("Las columnas de baja cardinalidad (canal, grupo, agencia, segmento, moneda, etc.) se guardan codificadas.")
+        else:
+            st.write("Guardar canal, grupo, agencia, segmento, act. económica, banca, moneda, I/E, marca y delito "
+                     "como códigos enteros en tablas de dimensiones. Convierte las filas existentes una sola vez.")
+            if st.button("Codificar dimensiones"):
+                with st.spinner("Codificando dimensiones y compactando la base..."), transaccion_escritura(DB_PATH) as escritor:
+                    activar_codificacion_dimensiones(escritor, compactar=True)
+                st.success("✅ Dimensiones codificadas")
+        
+        st.markdown("---")
+        if vacuum_incremental_habilitado(conn):
+            libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            st.write(f"Páginas libres pendientes de devolver al disco: {libres:,}")
+            if libres and st.button("Recuperar espacio"):
+                bar_espacio = st.progress(0, text="Recuperando espacio...")
+                with transaccion_escritura(DB_PATH) as escritor:
+                    liberados = recuperar_espacio(escritor, progress_callback=lambda p, n: bar_espacio.progress(p, text=f"{n:,} páginas"))
+                st.success(f"✅ {liberados / 1e6:,.1f} MB recuperados")
+        else:
+            st.write("La base no tiene recuperación incremental de espacio (auto_vacuum). "
+                     "Habilitarla requiere compactar la base una vez.")
+            if st.button("Habilitar recuperación incremental"):
+                with st.spinner("Compactando la base..."), transaccion_escritura(DB_PATH) as escritor:
+                    habilitar_vacuum_incremental(escritor)
+                st.success("✅ Recuperación incremental habilitada")
+        conn.close()
+    
+    with st.expander("🗑️ Eliminar carga"):
+        conn = get_connection()
+        df_purga = pd.read_sql_query("SELECT id_carga, codigo_carga, registros_totales FROM cargas ORDER BY fecha_carga DESC", conn)
+        if df_purga.empty:
+            st.info("No hay cargas registradas")
+        else:
+            id_purga = st.selectbox("Carga a eliminar", df_purga['id_carga'].tolist(),
+                                    format_func=lambda x: "{} ({:,} registros)".format(
+                                        *df_purga[df_purga['id_carga'] == x][['codigo_carga', 'registros_totales']].iloc[0].fillna(0)))
+            confirmar = st.checkbox("Confirmo que deseo eliminar todas las transacciones de esta carga")
+            if confirmar and st.button("Eliminar carga", type="primary"):
+                codigo_purga = df_purga[df_purga['id_carga'] == id_purga]['codigo_carga'].iloc[0]
+                en_cola = conn.execute("""
+                    SELECT 1 FROM trabajos_carga WHERE codigo_carga = ? AND estado IN ('PENDIENTE', 'EN_CURSO')
+                """, (codigo_purga,)).fetchone()
+                if en_cola:
+                    st.error("La carga tiene un trabajo en cola o en curso")
+                else:
+                    bar_purga = st.progress(0, text="Eliminando transacciones...")
+                    with transaccion_escritura(DB_PATH) as escritor:
+                        eliminadas = purgar_carga(escritor, id_purga,
+                                                  progress_callback=lambda p, n: bar_purga.progress(p, text=f"{n:,} transacciones eliminadas"))
+                        huerfanos = limpiar_huerfanos(escritor)
+                        recuperados = recuperar_espacio(escritor)
+                    st.success(f"✅ Carga eliminada: {eliminadas:,} transacciones, {huerfanos['clientes']:,} clientes sin uso"
+                               + (f", {recuperados / 1e6:,.1f} MB recuperados" if recuperados else ""))
+        conn.close()
+    
     conn = get_connection()
     try:
         df_cargas = pd.read_sql_query("""
-            SELECT codigo_carga, fecha_carga, registros_totales 
-            FROM cargas 
-            ORDER BY fecha_carga DESC
+            SELECT c.codigo_carga, c.fecha_carga, c.registros_totales, c.duplicados, c.estado, c.filas_confirmadas,
+                   e.clientes, e.fecha_min, e.fecha_max, e.monto_total
+            FROM cargas c
+            LEFT JOIN estadisticas_carga e ON e.id_carga = c.id_carga
+            ORDER BY c.fecha_carga DESC
         """, conn)
         
         if not df_cargas.empty:
@@ -154,50 +390,87 @@ elif menu == "Gestión de Casos":
         descripcion_caso = st.text_area("Descripción", placeholder="Descripción detallada del caso...")
         
         metodo_seleccion = st.radio("Método de selección de involucrados", 
-                                    ["Por Código de Cliente", "Por Código de Carga"])
+                                    ["Por Código de Cliente", "Por Reglas"])
         
         conn = get_connection()
         
         if metodo_seleccion == "Por Código de Cliente":
-            df_clientes = pd.read_sql_query("""
-                SELECT DISTINCT codunicocli_13_enc, destipdocumento, destipbanca, act_economica
-                FROM transacciones
-                ORDER BY codunicocli_13_enc
-            """, conn)
+            # Búsqueda paginada en el directorio de clientes; la selección se acumula entre búsquedas
+            if 'involucrados_nuevos' not in st.session_state:
+                st.session_state.involucrados_nuevos = set()
+            
+            prefijo = st.text_input("Código de cliente (prefijo)").strip()
+            col_act, col_seg, col_banca = st.columns(3)
+            atributos = {
+                'act_economica': col_act.selectbox("Actividad económica", ["TODAS"] + obtener_valores_catalogo(conn, 'act_economica')),
+                'segmento': col_seg.selectbox("Segmento", ["TODOS"] + obtener_valores_catalogo(conn, 'segmento')),
+                'destipbanca': col_banca.selectbox("Banca", ["TODAS"] + obtener_valores_catalogo(conn, 'destipbanca'))
+            }
+            atributos = {col: valor for col, valor in atributos.items() if valor not in ("TODAS", "TODOS")}
+            
+            por_pagina = 50
+            total_clientes = contar_clientes(conn, prefijo, atributos)
+            paginas = max(1, -(-total_clientes // por_pagina))
+            pagina = st.number_input(f"Página (de {paginas}, {total_clientes:,} clientes)", min_value=1, max_value=paginas, value=1)
+            df_clientes = buscar_clientes(conn, prefijo, atributos, limite=por_pagina, desplazamiento=(pagina - 1) * por_pagina)
             
             if not df_clientes.empty:
-                clientes_seleccionados = st.multiselect(
-                    "Seleccionar clientes involucrados",
-                    options=df_clientes['codunicocli_13_enc'].tolist(),
-                    format_func=lambda x: f"{x[:16]}... ({df_clientes[df_clientes['codunicocli_13_enc']==x]['destipdocumento'].iloc[0]})"
-                )
+                etiquetas = {codigo: f"{codigo[:16]}... ({documento})"
+                             for codigo, documento in zip(df_clientes['codunicocli_13_enc'], df_clientes['destipdocumento'])}
+                seleccion_pagina = st.multiselect("Clientes de esta página", options=list(etiquetas), format_func=etiquetas.get)
+                
+                col_agregar, col_limpiar = st.columns(2)
+                if col_agregar.button("Agregar a involucrados"):
+                    st.session_state.involucrados_nuevos.update(seleccion_pagina)
+                if col_limpiar.button("Limpiar selección"):
+                    st.session_state.involucrados_nuevos = set()
+            else:
+                st.info("No hay clientes que coincidan con la búsqueda")
+            
+            clientes_seleccionados = sorted(st.session_state.involucrados_nuevos)
+            st.caption(f"{len(clientes_seleccionados):,} clientes seleccionados como involucrados")
         else:
-            df_cargas = pd.read_sql_query("SELECT codigo_carga FROM cargas", conn)
+            # La cohorte se evalúa en la base: vista previa con COUNT y alta con un único INSERT ... SELECT
+            df_cargas = pd.read_sql_query("SELECT codigo_carga FROM cargas ORDER BY fecha_carga DESC", conn)
+            carga_seleccionada = st.selectbox("Carga", ["TODAS"] + df_cargas['codigo_carga'].tolist())
             
-            if not df_cargas.empty:
-                carga_seleccionada = st.selectbox("Seleccionar carga", 
-                                                  df_cargas['codigo_carga'].tolist())
-                
-                if carga_seleccionada:
-                    df_clientes_carga = pd.read_sql_query("""
-                        SELECT DISTINCT t.codunicocli_13_enc
-                        FROM transacciones t
-                        INNER JOIN cargas c ON t.id_carga = c.id_carga
-                        WHERE c.codigo_carga = ?
-                    """, conn, params=[carga_seleccionada])
-                    
-                    clientes_seleccionados = df_clientes_carga['codunicocli_13_enc'].tolist()
-                    st.info(f"Se agregarán {len(clientes_seleccionados)} clientes de esta carga")
+            col_act, col_seg = st.columns(2)
+            col_marca, col_delito = st.columns(2)
+            reglas = {
+                'codigo_carga': None if carga_seleccionada == "TODAS" else carga_seleccionada,
+                'act_economica': col_act.multiselect("Actividad económica", obtener_valores_catalogo(conn, 'act_economica')),
+                'segmento': col_seg.multiselect("Segmento", obtener_valores_catalogo(conn, 'segmento')),
+                'tipo_marca': col_marca.multiselect("Tipo de marca", obtener_valores_catalogo(conn, 'tipo_marca')),
+                'delito': col_delito.multiselect("Delito", obtener_valores_catalogo(conn, 'delito'))
+            }
+            
+            col_monto, col_ops = st.columns(2)
+            reglas['monto_total_min'] = col_monto.number_input("Monto total mínimo por cliente", min_value=0.0, value=0.0)
+            reglas['operaciones_min'] = col_ops.number_input("Operaciones mínimas por cliente", min_value=0, value=0)
+            
+            if st.checkbox("Limitar a una ventana de fechas"):
+                col_desde, col_hasta = st.columns(2)
+                reglas['fecha_min'] = col_desde.date_input("Desde", value=date(2016, 1, 1)).strftime('%Y-%m-%d')
+                reglas['fecha_max'] = col_hasta.date_input("Hasta").strftime('%Y-%m-%d')
+            
+            if reglas_vacias(reglas):
+                st.warning("Elija una carga o defina al menos una regla; sin reglas se incluiría a todos los clientes")
+            elif st.button("Vista previa"):
+                st.info(f"La regla selecciona {contar_cohorte(conn, reglas):,} clientes")
         
         if nombre_caso and st.button("Crear Caso", type="primary"):
+            creado = False
+            escritor = get_connection(escritura=True)
             try:
-                cursor = conn.cursor()
+                cursor = escritor.cursor()
                 
                 existe = cursor.execute("SELECT id_caso FROM casos WHERE nombre_caso = ?", 
                                       (nombre_caso,)).fetchone()
                 
                 if existe:
                     st.error("Ya existe un caso con este nombre")
+                elif metodo_seleccion == "Por Reglas" and reglas_vacias(reglas):
+                    st.error("Defina al menos una regla antes de crear el caso")
                 else:
                     cursor.execute("""
                         INSERT INTO casos (nombre_caso, descripcion) 
@@ -206,19 +479,27 @@ elif menu == "Gestión de Casos":
                     
                     id_caso = cursor.lastrowid
                     
-                    if 'clientes_seleccionados' in locals() and clientes_seleccionados:
-                        for cliente in clientes_seleccionados:
-                            cursor.execute("""
-                                INSERT INTO caso_involucrados (id_caso, codunicocli_13_enc)
-                                VALUES (?, ?)
-                            """, (id_caso, cliente))
-                    
-                    conn.commit()
-                    st.success(f"✅ Caso creado exitosamente con {len(clientes_seleccionados) if 'clientes_seleccionados' in locals() else 0} involucrados")
-                    st.rerun()
+                    num_involucrados = 0
+                    if metodo_seleccion == "Por Reglas":
+                        num_involucrados = insertar_involucrados_por_reglas(escritor, id_caso, reglas)
+                    elif clientes_seleccionados:
+                        cursor.executemany("""
+                            INSERT INTO caso_involucrados (id_caso, codunicocli_13_enc, id_cliente)
+                            SELECT ?, codunicocli_13_enc, id_cliente FROM clientes WHERE codunicocli_13_enc = ?
+                        """, [(id_caso, cliente) for cliente in clientes_seleccionados])
+                        num_involucrados = len(clientes_seleccionados)
+                    
+                    escritor.commit()
+                    creado = True
+                    st.session_state.involucrados_nuevos = set()
+                    st.success(f"✅ Caso creado exitosamente con {num_involucrados:,} involucrados")
                     
             except Exception as e:
                 st.error(f"Error al crear caso: {str(e)}")
+            finally:
+                escritor.close()
+            if creado:
+                st.rerun()
         
         conn.close()
     
@@ -226,36 +507,30 @@ elif menu == "Gestión de Casos":
         st.markdown("### Casos Existentes")
         
         conn = get_connection()
-        df_casos = pd.read_sql_query("""
-            SELECT c.id_caso, c.nombre_caso, c.descripcion, c.fecha_creacion,
-                   COUNT(ci.codunicocli_13_enc) as num_involucrados
-            FROM casos c
-            LEFT JOIN caso_involucrados ci ON c.id_caso = ci.id_caso
-            GROUP BY c.id_caso
-            ORDER BY c.fecha_creacion DESC
-        """, conn)
+        df_casos = obtener_listado_casos(conn)
         
         if not df_casos.empty:
-            for _, caso in df_casos.iterrows():
-                with st.expander(f"📋 {caso['nombre_caso']} ({caso['num_involucrados']} involucrados)"):
-                    st.write(f"**Descripción:** {caso['descripcion'] or 'Sin descripción'}")
-                    st.write(f"**Fecha creación:** {caso['fecha_creacion']}")
-                    
-                    df_involucrados = pd.read_sql_query("""
-                        SELECT ci.codunicocli_13_enc, t.destipdocumento, t.destipbanca, t.act_economica
-                        FROM caso_involucrados ci
-                        LEFT JOIN transacciones t ON ci.codunicocli_13_enc = t.codunicocli_13_enc
-                        WHERE ci.id_caso = ?
-                        GROUP BY ci.codunicocli_13_enc
-                    """, conn, params=[caso['id_caso']])
-                    
-                    if not df_involucrados.empty:
+            for caso in df_casos.itertuples():
+                with st.expander(f"📋 {caso.nombre_caso} ({caso.num_involucrados:,} involucrados)"):
+                    st.write(f"**Descripción:** {caso.descripcion or 'Sin descripción'}")
+                    st.write(f"**Fecha creación:** {caso.fecha_creacion}")
+                    st.caption(f"DNI: {int(caso.num_dni or 0):,} · RUC: {int(caso.num_ruc or 0):,}")
+                    
+                    # El detalle se consulta solo al pedirlo, de a una página
+                    if caso.num_involucrados and st.toggle("Ver involucrados", key=f"ver_{caso.id_caso}"):
+                        por_pagina = 50
+                        paginas = max(1, -(-caso.num_involucrados // por_pagina))
+                        pagina = 1
+                        if paginas > 1:
+                            pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1,
+                                                     key=f"pag_{caso.id_caso}")
+                        df_involucrados = obtener_involucrados_caso(conn, caso.id_caso, limite=por_pagina,
+                                                                    desplazamiento=(pagina - 1) * por_pagina)
                         st.dataframe(df_involucrados, use_container_width=True)
                     
-                    if st.button(f"Eliminar caso", key=f"del_{caso['id_caso']}"):
-                        cursor = conn.cursor()
-                        cursor.execute("DELETE FROM casos WHERE id_caso = ?", (caso['id_caso'],))
-                        conn.commit()
+                    if st.button(f"Eliminar caso", key=f"del_{caso.id_caso}"):
+                        with transaccion_escritura(DB_PATH) as escritor:
+                            escritor.execute("DELETE FROM casos WHERE id_caso = ?", (int(caso.id_caso),))
                         st.success("Caso eliminado")
                         st.rerun()
         else:
@@ -280,33 +555,35 @@ elif menu == "Análisis de Patrones":
         
         st.sidebar.markdown("### Filtros Generales")
         
-        filtro_moneda = st.sidebar.selectbox("Moneda", ["AMBOS", "SOLES", "DOLARES"])
+        # Valores y rangos del perfil guardado del caso; solo se recalcula tras una carga o un cambio de involucrados
+        perfil = obtener_perfil_caso(conn, DB_PATH, id_caso)
+        
+        por_moneda = perfil['filas_por_moneda']
+        por_ie = {k.upper(): v for k, v in perfil['filas_por_ie'].items()}
+        filtro_moneda = st.sidebar.selectbox("Moneda", ["AMBOS", "SOLES", "DOLARES"],
+                                             format_func=lambda v: v if v == "AMBOS" else f"{v} ({por_moneda.get(v, 0):,})")
         filtro_tipo_doc = st.sidebar.selectbox("Tipo Documento", ["AMBOS", "DNI", "RUC"])
-        filtro_ie = st.sidebar.selectbox("Tipo Transacción (I/E)", ["AMBOS", "INGRESO", "EGRESO"])
+        filtro_ie = st.sidebar.selectbox("Tipo Transacción (I/E)", ["AMBOS", "INGRESO", "EGRESO"],
+                                         format_func=lambda v: v if v == "AMBOS" else f"{v} ({por_ie.get(v, 0):,})")
 
-        # Obtener segmentos disponibles para el caso
-        df_segmentos = pd.read_sql_query("""
-            SELECT DISTINCT t.segmento 
-            FROM transacciones t
-            INNER JOIN caso_involucrados ci ON t.codunicocli_13_enc = ci.codunicocli_13_enc
-            WHERE ci.id_caso = ?
-            ORDER BY t.segmento
-        """, conn, params=[int(id_caso)])
-        
-        segmentos_disponibles = sorted([s for s in df_segmentos['segmento'].dropna().unique() if s])
+        segmentos_disponibles = perfil['valores']['segmento']
         filtro_segmento = st.sidebar.multiselect("Segmento", segmentos_disponibles, default=segmentos_disponibles)
         
         col1, col2 = st.sidebar.columns(2)
-        filtro_monto_min = col1.number_input("Monto Mínimo", min_value=0.0, value=0.0)
-        filtro_monto_max = col2.number_input("Monto Máximo", min_value=0.0, value=1000000.0)
-        fecha_inicio_default = date(2016, 1, 1)
+        monto_min_caso = max(0.0, float(np.floor(perfil['monto_min']))) if perfil['monto_min'] is not None else 0.0
+        monto_max_caso = float(np.ceil(perfil['monto_max'])) if perfil['monto_max'] is not None else 1000000.0
+        filtro_monto_min = col1.number_input("Monto Mínimo", min_value=0.0, value=monto_min_caso)
+        filtro_monto_max = col2.number_input("Monto Máximo", min_value=0.0, value=max(monto_max_caso, monto_min_caso))
 
         filtro_fecha_min = st.sidebar.date_input(
             "Fecha Mínima",
-            value=fecha_inicio_default
+            value=date.fromisoformat(perfil['fecha_min']) if perfil['fecha_min'] else date(2016, 1, 1)
         )
-        #filtro_fecha_min = st.sidebar.date_input("Fecha Mínima")
-        filtro_fecha_max = st.sidebar.date_input("Fecha Máxima")
+        filtro_fecha_max = st.sidebar.date_input(
+            "Fecha Máxima",
+            value=date.fromisoformat(perfil['fecha_max']) if perfil['fecha_max'] else date.today()
+        )
+        st.sidebar.caption(f"{perfil['filas']:,} operaciones con monto en el caso")
         
         filtros = {
             'moneda': filtro_moneda,
@@ -316,32 +593,42 @@ elif menu == "Análisis de Patrones":
             'monto_min': filtro_monto_min,
             'monto_max': filtro_monto_max,
             'fecha_min': filtro_fecha_min.strftime('%Y-%m-%d') if filtro_fecha_min else None,
-            'fecha_max': filtro_fecha_max.strftime('%Y-%m-%d') if filtro_fecha_max else None
+            # fecha se guarda con hora: el día máximo se incluye completo
+            'fecha_max': filtro_fecha_max.strftime('%Y-%m-%d 23:59:59') if filtro_fecha_max else None
         }
         
-        df_caso = obtener_datos_caso(id_caso, conn, filtros)
+        tipo_analisis = st.selectbox("Seleccionar Tipo de Análisis", list(COLUMNAS_ANALISIS))
         
-        st.info(f"Total de transacciones en el caso: {len(df_caso):,}")
+        alcance_base = False
+        if tipo_analisis in ANALISIS_CUBO:
+            alcance_base = st.radio("Alcance", ["Caso seleccionado", "Toda la base"], horizontal=True) == "Toda la base"
         
-        tipo_analisis = st.selectbox("Seleccionar Tipo de Análisis", [
-            "Top 10 General",
-            "1. Detección de Falsos Transportistas",
-            "2. Segmento Bancario vs Volumen",
-            "3. Actividad Económica vs Efectivo",
-            "4. Concentración de Efectivo por Agencia",
-            "5. Pitufeo Digital (Yape/Plin)",
-            "6. Retiros Hormiga en Cajeros",
-            "7. Preferencia por Operador",
-            "8. Red de Proveedores Comunes",
-            "9. Cuentas Descartables",
-            "10. Velocidad del Dinero",
-            "11. Comportamiento por Marca",
-            "12. Divisa por Delito",
-            "13. Cuentas Puente",
-            "14. Matriz Colusión Cliente-Operador",
-            "15. Explosión de Pitufeo",
-            "16. Minería de Texto en Glosas"
-        ])
+        # Los detectores por día leen el resumen diario; None si los filtros obligan a ir a las filas
+        resumen_diario = None
+        if tipo_analisis in ANALISIS_RESUMEN_DIARIO:
+            resumen_diario = obtener_resumen_diario_caso(id_caso, conn, filtros)
+        
+        if alcance_base:
+            # Toda la base se responde desde el cubo mensual, sin leer filas
+            df_caso = None
+            total_base = totales_por(None, ['moneda'], conn, filtros, dropna=False)['id_transaccion'].sum()
+            st.info(f"Total de transacciones en la base: {int(total_base):,}")
+            st.caption("Totales mensuales: el rango de fechas se aplica por mes completo y el de monto no se aplica")
+        elif resumen_diario is not None and ANALISIS_RESUMEN_DIARIO[tipo_analisis]:
+            df_caso = None
+            st.info(f"Total de transacciones en el caso: {int(resumen_diario['operaciones'].sum()):,}")
+        else:
+            # Solo se leen las columnas que declara el análisis seleccionado; los filtros se aplican en memoria
+            df_caso = filtrar_caso_memoria(id_caso, conn, filtros, columnas=COLUMNAS_ANALISIS[tipo_analisis])
+            st.info(f"Total de transacciones en el caso: {len(df_caso):,}")
+            
+            with st.sidebar.expander("🩺 Plan de consulta"):
+                plan = diagnosticar_consulta_caso(id_caso, conn, columnas=COLUMNAS_ANALISIS[tipo_analisis])
+                if plan['escaneo_completo'].any():
+                    st.warning("La lectura del caso recorre la tabla completa (no usa índice)")
+                else:
+                    st.caption("La lectura del caso usa índices")
+                st.dataframe(plan[['detalle', 'escaneo_completo']], use_container_width=True, hide_index=True)
         
         agregar_reporte = False
         
@@ -366,16 +653,14 @@ elif menu == "Análisis de Patrones":
                 
                 columna = mapeo_columnas[categoria]
                 
-                df_top = df_caso.groupby(columna).agg({
-                    'monto': 'sum',
-                    'id_transaccion': 'count'
-                }).reset_index()
+                df_columna_moneda = totales_por(df_caso, [columna, 'moneda'], conn, filtros, dropna=False)
+                df_top = df_columna_moneda.groupby(columna)[['monto', 'id_transaccion']].sum().reset_index()
                 
                 df_top.columns = [categoria, 'Monto Total', 'Cantidad Operaciones']
                 df_top = df_top.sort_values('Monto Total', ascending=False).head(10)
                 
-                df_soles = df_caso[df_caso['moneda'] == 'SOLES'].groupby(columna)['monto'].sum()
-                df_dolares = df_caso[df_caso['moneda'] == 'DOLARES'].groupby(columna)['monto'].sum()
+                df_soles = df_columna_moneda[df_columna_moneda['moneda'] == 'SOLES'].groupby(columna)['monto'].sum()
+                df_dolares = df_columna_moneda[df_columna_moneda['moneda'] == 'DOLARES'].groupby(columna)['monto'].sum()
                 
                 df_top['Monto Soles'] = df_top[categoria].map(df_soles).fillna(0)
                 df_top['Monto Dólares'] = df_top[categoria].map(df_dolares).fillna(0)
@@ -635,12 +920,10 @@ elif menu == "Análisis de Patrones":
             st.markdown("### 🏦 Concentración de Efectivo por Agencia")
             
             if st.button("Analizar"):
-                df_efectivo = df_caso[df_caso['grupo'].isin(['RETIRO', 'DEPOSITO'])]
+                df_efectivo = totales_por(df_caso, ['agencia', 'grupo'], conn, filtros)
+                df_efectivo = df_efectivo[df_efectivo['grupo'].isin(['RETIRO', 'DEPOSITO'])]
                 
-                df_agencias = df_efectivo.groupby('agencia').agg({
-                    'monto': 'sum',
-                    'id_transaccion': 'count'
-                }).reset_index()
+                df_agencias = df_efectivo.groupby('agencia')[['monto', 'id_transaccion']].sum().reset_index()
                 df_agencias.columns = ['Agencia', 'Monto Total', 'Num Operaciones']
                 df_agencias = df_agencias.sort_values('Monto Total', ascending=False).head(10)
                 
@@ -767,8 +1050,14 @@ elif menu == "Análisis de Patrones":
                     if not sospechosos.empty:
                         st.warning(f"⚠️ {len(sospechosos)} clientes con más de 50 micropagos")
 
-                    df_digital['fecha_dt'] = pd.to_datetime(df_digital['fecha'])
-                    df_diario = df_digital.groupby('fecha_dt').size().reset_index()
+                    resumen_digital = None
+                    if resumen_diario is not None:
+                        resumen_digital = recortar_resumen_monto(resumen_diario[resumen_diario['grupo'].isin(grupos_busqueda)],
+                                                                 maximo=monto_max_pitufeo, incluir_maximo=False)
+                    if resumen_digital is not None:
+                        df_diario = resumen_digital.groupby('fecha_dt')['operaciones'].sum().reset_index()
+                    else:
+                        df_diario = df_digital.groupby('fecha_dt').size().reset_index()
                     df_diario.columns = ['Fecha', 'Cantidad']
                     
                     fig = px.line(df_diario, x='Fecha', y='Cantidad',
@@ -812,8 +1101,6 @@ elif menu == "Análisis de Patrones":
                 ]
                 
                 if not df_cajeros.empty:
-                    df_cajeros['fecha_dt'] = pd.to_datetime(df_cajeros['fecha'])
-                    df_cajeros['hora_num'] = pd.to_datetime(df_cajeros['hora'], format='mixed', errors='coerce').dt.hour
                     df_cajeros = df_cajeros.dropna(subset=['hora_num'])
                     df_por_cliente_dia = df_cajeros.groupby(
                         ['codunicocli_13_enc', 'fecha_dt']
@@ -1040,10 +1327,6 @@ elif menu == "Análisis de Patrones":
             
             if st.button("Analizar"):
 
-                # Convertir fechas antes de agrupar para evitar errores de tipo
-                df_caso['fecapertura'] = pd.to_datetime(df_caso['fecapertura'], errors='coerce')
-                df_caso['feccierre'] = pd.to_datetime(df_caso['feccierre'], errors='coerce')
-
                 # Agregación inicial para obtener fechas y cuenta
                 df_cuentas = df_caso.groupby('codunicocli_13_enc').agg({
                     'fecapertura': 'max',
@@ -1061,9 +1344,6 @@ elif menu == "Análisis de Patrones":
                 }).rename(columns={'monto': 'monto_apertura', 'glosa': 'top_glosas'})
                 
                 df_cuentas = pd.merge(df_cuentas, df_detalles, on='codunicocli_13_enc')
-
-                df_cuentas['fecapertura'] = pd.to_datetime(df_cuentas['fecapertura'], errors='coerce')
-                df_cuentas['feccierre'] = pd.to_datetime(df_cuentas['feccierre'], errors='coerce')
                 
                 df_cerradas = df_cuentas[df_cuentas['feccierre'].notna()].copy()
                 
@@ -1110,11 +1390,13 @@ elif menu == "Análisis de Patrones":
             st.markdown("### 💸 Análisis de Velocidad del Dinero (Pass-Through)")
             
             if st.button("Analizar"):
-                df_caso['fecha_dt'] = pd.to_datetime(df_caso['fecha'])
-                
-                df_diario = df_caso.groupby(['codunicocli_13_enc', 'fecha_dt', 'i_e']).agg({
-                    'monto': 'sum'
-                }).reset_index()
+                if df_caso is None:
+                    df_diario = resumen_diario.groupby(['codunicocli_13_enc', 'fecha_dt', 'i_e'])['monto_total'].sum() \
+                        .reset_index().rename(columns={'monto_total': 'monto'})
+                else:
+                    df_diario = df_caso.groupby(['codunicocli_13_enc', 'fecha_dt', 'i_e']).agg({
+                        'monto': 'sum'
+                    }).reset_index()
                 
                 df_pivot = df_diario.pivot_table(
                     index=['codunicocli_13_enc', 'fecha_dt'],
@@ -1183,19 +1465,19 @@ elif menu == "Análisis de Patrones":
         elif tipo_analisis == "11. Comportamiento por Marca":
             st.markdown("### 🏷️ Comportamiento Diferenciado por Marca")
             
+            # Totales por marca y grupo (incluye los vacíos para que los porcentajes usen toda la muestra)
+            df_marca_grupo = totales_por(df_caso, ['tipo_marca', 'grupo'], conn, filtros, dropna=False)
+            
             # 1. Filtro afuera
-            marcas_disponibles = ['TODAS'] + sorted([str(m) for m in df_caso['tipo_marca'].dropna().unique()])
+            marcas_disponibles = ['TODAS'] + sorted([str(m) for m in df_marca_grupo['tipo_marca'].dropna().unique()])
             marca_seleccionada = st.selectbox("Filtrar por Tipo de Marca", marcas_disponibles)
 
             if st.button("Analizar"):
                 # 2. Porcentaje del total de operaciones de toda la muestra por cada tipo de marca
-                total_ops_global = len(df_caso)
-                total_monto_global = df_caso['monto'].sum()
+                total_ops_global = df_marca_grupo['id_transaccion'].sum()
+                total_monto_global = df_marca_grupo['monto'].sum()
                 
-                df_resumen_marcas = df_caso.groupby('tipo_marca').agg({
-                    'id_transaccion': 'count',
-                    'monto': 'sum'
-                }).reset_index()
+                df_resumen_marcas = df_marca_grupo.groupby('tipo_marca')[['id_transaccion', 'monto']].sum().reset_index()
                 
                 df_resumen_marcas['% Operaciones'] = (df_resumen_marcas['id_transaccion'] / total_ops_global) * 100
                 df_resumen_marcas['% Monto'] = (df_resumen_marcas['monto'] / total_monto_global) * 100
@@ -1224,17 +1506,16 @@ elif menu == "Análisis de Patrones":
                 
                 # Filter for detailed analysis
                 if marca_seleccionada != 'TODAS':
-                    df_analisis = df_caso[df_caso['tipo_marca'] == marca_seleccionada]
+                    df_analisis = df_marca_grupo[df_marca_grupo['tipo_marca'] == marca_seleccionada]
                     st.markdown(f"#### Detalle para: {marca_seleccionada}")
                 else:
-                    df_analisis = df_caso
+                    df_analisis = df_marca_grupo
                     st.markdown("#### Detalle Global")
 
                 # Existing Detailed Analysis (breakdown by Group)
-                df_por_marca_grupo = df_analisis.groupby(['tipo_marca', 'grupo']).agg({
-                    'monto': 'sum',
-                    'id_transaccion': 'count'
-                }).reset_index()
+                df_por_marca_grupo = df_analisis.dropna(subset=['tipo_marca', 'grupo'])[
+                    ['tipo_marca', 'grupo', 'monto', 'id_transaccion']
+                ].reset_index(drop=True)
                 
                 st.dataframe(df_por_marca_grupo, use_container_width=True)
                 
@@ -1272,10 +1553,9 @@ elif menu == "Análisis de Patrones":
             st.markdown("### 💱 Análisis de Divisa por Delito")
             
             if st.button("Analizar"):
-                df_delito_moneda = df_caso.groupby(['delito', 'moneda']).agg({
-                    'monto': 'sum',
-                    'id_transaccion': 'count'
-                }).reset_index()
+                df_delito_moneda = totales_por(df_caso, ['delito', 'moneda'], conn, filtros)[
+                    ['delito', 'moneda', 'monto', 'id_transaccion']
+                ]
                 
                 if not df_delito_moneda.empty:
                     st.dataframe(df_delito_moneda, use_container_width=True)
@@ -1305,13 +1585,15 @@ elif menu == "Análisis de Patrones":
             st.markdown("### 🌉 Detección de Cuentas Puente")
             
             if st.button("Analizar"):
-                df_caso['fecha_dt'] = pd.to_datetime(df_caso['fecha'])
-                
-                df_filtrado = df_caso[df_caso['grupo'].isin(['TRANSFERENCIA', 'TT OTRA CTA', 'CHEQUE'])]
-                
-                df_diario = df_filtrado.groupby(['codunicocli_13_enc', 'act_economica', 'fecha_dt', 'i_e']).agg({
-                    'monto': 'sum'
-                }).reset_index()
+                if df_caso is None:
+                    df_filtrado = resumen_diario[resumen_diario['grupo'].isin(['TRANSFERENCIA', 'TT OTRA CTA', 'CHEQUE'])]
+                    df_diario = df_filtrado.groupby(['codunicocli_13_enc', 'act_economica', 'fecha_dt', 'i_e'])['monto_total'].sum() \
+                        .reset_index().rename(columns={'monto_total': 'monto'})
+                else:
+                    df_filtrado = df_caso[df_caso['grupo'].isin(['TRANSFERENCIA', 'TT OTRA CTA', 'CHEQUE'])]
+                    df_diario = df_filtrado.groupby(['codunicocli_13_enc', 'act_economica', 'fecha_dt', 'i_e']).agg({
+                        'monto': 'sum'
+                    }).reset_index()
                 
                 df_pivot = df_diario.pivot_table(
                     index=['codunicocli_13_enc', 'act_economica', 'fecha_dt'],
@@ -1456,13 +1738,7 @@ elif menu == "Análisis de Patrones":
                 ].copy()
                 
                 if not df_bajo_monto.empty: 
-                    # SOLUCIÓN: Usar errors='coerce' para manejar horas inválidas como 99:99:99
-                    df_bajo_monto['fecha_hora'] = pd.to_datetime(
-                        df_bajo_monto['fecha'].astype(str) + ' ' + df_bajo_monto['hora'].astype(str),
-                        errors='coerce'
-                    )
-                    
-                    # Eliminar registros con datos de tiempo corruptos
+                    # Eliminar registros con datos de tiempo corruptos (p. ej. hora 99:99:99)
                     df_bajo_monto = df_bajo_monto.dropna(subset=['fecha_hora'])
                     df_bajo_monto = df_bajo_monto.sort_values('fecha_hora')
                     
@@ -1632,12 +1908,11 @@ elif menu == "Análisis de Patrones":
                     st.info("No hay egresos")
         
         if agregar_reporte and st.button("💾 Guardar análisis para reporte PDF"):
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO reportes_generados (id_caso, tipo_reporte, configuracion, incluir_en_pdf)
-                VALUES (?, ?, ?, 1)
-            """, (id_caso, tipo_analisis, json.dumps(filtros)))
-            conn.commit()
+            with transaccion_escritura(DB_PATH) as escritor:
+                escritor.execute("""
+                    INSERT INTO reportes_generados (id_caso, tipo_reporte, configuracion, incluir_en_pdf)
+                    VALUES (?, ?, ?, 1)
+                """, (id_caso, tipo_analisis, json.dumps(filtros)))
             st.success("✅ Análisis guardado para el reporte PDF")
         
         conn.close()
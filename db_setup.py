@@ -1,17 +1,197 @@
 import sqlite3
 import os
+import pandas as pd
+import utils
+
+# Columnas agregadas después de la versión inicial del esquema (bases ya existentes)
+COLUMNAS_NUEVAS = {
+    'cargas': [
+        ('estado', "TEXT DEFAULT 'COMPLETA'"),
+        ('filas_confirmadas', 'INTEGER DEFAULT 0'),
+        ('duplicados', 'INTEGER DEFAULT 0'),
+        ('huella_archivo', 'TEXT')
+    ],
+    'transacciones': [
+        ('hash_natural', 'INTEGER'),
+        ('duplicado', 'INTEGER DEFAULT 0'),
+        ('id_cliente', 'INTEGER REFERENCES clientes(id_cliente)'),
+        ('ts_epoch', 'INTEGER'),
+        ('fecha_int', 'INTEGER'),
+        ('segundos_dia', 'INTEGER'),
+        ('fecha_hora_valida', 'INTEGER DEFAULT 0'),
+        ('fecapertura_int', 'INTEGER'),
+        ('feccierre_int', 'INTEGER')
+    ],
+    'caso_involucrados': [
+        ('id_cliente', 'INTEGER REFERENCES clientes(id_cliente)')
+    ],
+    'clientes': [
+        ('destipdocumento', 'TEXT'),
+        ('destipbanca', 'TEXT'),
+        ('segmento', 'TEXT'),
+        ('act_economica', 'TEXT')
+    ]
+}
+
+# Atributos del directorio de clientes: valor de la última transacción, decodificado si las dimensiones
+# están guardadas como códigos
+RELLENO_ATRIBUTOS_CLIENTES = [
+    f"""UPDATE clientes SET {col} = (
+           SELECT t.{col} FROM transacciones t WHERE t.id_cliente = clientes.id_cliente
+           ORDER BY t.id_transaccion DESC LIMIT 1
+       )"""
+    for col in ['destipdocumento', 'destipbanca', 'segmento', 'act_economica']
+] + [
+    f"""UPDATE clientes SET {col} = (
+           SELECT d.valor FROM dimensiones d WHERE d.dimension = '{col}' AND d.codigo = clientes.{col}
+       )
+       WHERE {col} IS NOT NULL
+         AND EXISTS (SELECT 1 FROM configuracion_sistema WHERE clave = 'dimensiones_codificadas' AND valor = '1')"""
+    for col in ['destipbanca', 'segmento', 'act_economica']
+]
+
+def rellenar_por_lotes(conn, columnas_origen, calcular, lote=50000):
+    # Recalcula columnas de transacciones con las mismas funciones que usa la carga, por lotes de id
+    ultimo = 0
+    while True:
+        df = pd.read_sql_query(f"""
+            SELECT id_transaccion, {', '.join(columnas_origen)} FROM transacciones
+            WHERE id_transaccion > ? ORDER BY id_transaccion LIMIT ?
+        """, conn, params=[ultimo, lote])
+        if df.empty:
+            break
+        valores = calcular(df)
+        valores['id_transaccion'] = df['id_transaccion']
+        columnas = [col for col in valores.columns if col != 'id_transaccion']
+        conn.executemany(f"UPDATE transacciones SET {', '.join(f'{col} = ?' for col in columnas)} WHERE id_transaccion = ?",
+                         utils.filas_sqlite(valores[columnas + ['id_transaccion']]))
+        ultimo = int(df['id_transaccion'].iloc[-1])
+
+def rellenar_marcas_tiempo(conn):
+    # parsear_horas descarta horas como 24:xx que time() de SQLite acepta
+    rellenar_por_lotes(conn, ['fecha', 'hora', 'fecapertura', 'feccierre'], utils.calcular_marcas_tiempo)
+
+def rellenar_hash_natural(conn):
+    # Sin el hash, las filas previas a la migración no se detectarían como duplicados al recargarlas.
+    # El índice se crea después del relleno
+    conn.execute("DROP INDEX IF EXISTS idx_hash_natural")
+    rellenar_por_lotes(conn, utils.COLUMNAS_CLAVE_NATURAL,
+                       lambda df: pd.DataFrame({'hash_natural': utils.calcular_hash_natural(df)}, index=df.index))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_hash_natural ON transacciones(hash_natural)")
+
+# Datos a completar la primera vez que se agrega una columna (se ejecutan después del esquema); cada
+# entrada es una sentencia SQL o una función que recibe la conexión
+RELLENOS = {
+    ('transacciones', 'hash_natural'): [rellenar_hash_natural],
+    ('transacciones', 'id_cliente'): [
+        "INSERT OR IGNORE INTO clientes (codunicocli_13_enc) SELECT DISTINCT codunicocli_13_enc FROM transacciones",
+        """UPDATE transacciones SET id_cliente = (
+               SELECT c.id_cliente FROM clientes c WHERE c.codunicocli_13_enc = transacciones.codunicocli_13_enc
+           )""",
+        "DROP INDEX IF EXISTS idx_cliente"
+    ] + RELLENO_ATRIBUTOS_CLIENTES,
+    ('transacciones', 'ts_epoch'): [rellenar_marcas_tiempo],
+    ('clientes', 'act_economica'): RELLENO_ATRIBUTOS_CLIENTES,
+    ('caso_involucrados', 'id_cliente'): [
+        "INSERT OR IGNORE INTO clientes (codunicocli_13_enc) SELECT DISTINCT codunicocli_13_enc FROM caso_involucrados",
+        """UPDATE caso_involucrados SET id_cliente = (
+               SELECT c.id_cliente FROM clientes c WHERE c.codunicocli_13_enc = caso_involucrados.codunicocli_13_enc
+           )"""
+    ]
+}
+
+def rellenar_agregados(conn):
+    # Tablas derivadas vacías en una base con datos: se arman por carga con los mismos constructores de
+    # utils que usa el cierre de cada carga (las cargas en curso o en borrado se arman al completarse)
+    cargas = [fila[0] for fila in conn.execute(
+        "SELECT id_carga FROM cargas WHERE COALESCE(estado, 'COMPLETA') = 'COMPLETA'")]
+    for tabla, sql in utils.TABLAS_AGREGADAS.items():
+        if conn.execute(f"SELECT EXISTS (SELECT 1 FROM {tabla})").fetchone()[0]:
+            continue
+        for id_carga in cargas:
+            conn.execute(sql("id_carga = ?"), (id_carga,))
+
+# Versión del parseo de fechas con que se calcularon hash_natural y las marcas de tiempo de las filas
+# existentes. La 2 hashea la fecha ya parseada y lee dd/mm/aaaa con el día primero: al subirla se recalculan
+VERSION_FECHAS = '2'
+
+def recalcular_fechas(conn):
+    fila = conn.execute("SELECT valor FROM configuracion_sistema WHERE clave = 'version_fechas'").fetchone()
+    if fila and fila[0] == VERSION_FECHAS:
+        return
+    if conn.execute("SELECT EXISTS (SELECT 1 FROM transacciones)").fetchone()[0]:
+        rellenar_hash_natural(conn)
+        rellenar_marcas_tiempo(conn)
+        utils.reconstruir_agregados(conn)
+    marcar_version_fechas(conn)
+
+def marcar_version_fechas(conn):
+    conn.execute("""
+        INSERT OR REPLACE INTO configuracion_sistema (clave, valor, descripcion)
+        VALUES ('version_fechas', ?, 'Versión del parseo de fechas de hash_natural y las marcas de tiempo')
+    """, (VERSION_FECHAS,))
+
+# Índices reemplazados por otros compuestos (ver schema.sql)
+INDICES_OBSOLETOS = ['idx_id_cliente']
+
+# Triggers reemplazados (trg_version_cargas_update subía la versión con cada avance de una carga)
+TRIGGERS_OBSOLETOS = ['trg_version_cargas_update']
 
 def setup_database(db_path='aml_data.db'):
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
+    # Debe fijarse antes de crear tablas; permite recuperar espacio con PRAGMA incremental_vacuum
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    # WAL es persistente en el archivo: los lectores no se bloquean mientras hay una carga en curso
+    cursor.execute("PRAGMA journal_mode = WAL")
     
     with open('schema.sql', 'r') as f:
         schema_sql = f.read()
     
     cursor.executescript(schema_sql)
+    marcar_version_fechas(cursor)
     conn.commit()
     conn.close()
     print(f"Base de datos creada exitosamente en: {db_path}")
 
+def actualizar_esquema(db_path='aml_data.db'):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
+    agregadas = []
+    for tabla, columnas in COLUMNAS_NUEVAS.items():
+        existentes = {fila[1] for fila in cursor.execute(f"PRAGMA table_info({tabla})")}
+        if not existentes:
+            continue
+        for nombre, definicion in columnas:
+            if nombre not in existentes:
+                cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {definicion}")
+                agregadas.append((tabla, nombre))
+    
+    with open('schema.sql', 'r') as f:
+        schema_sql = f.read()
+    
+    cursor.executescript(schema_sql)
+    
+    for columna in agregadas:
+        for sql in RELLENOS.get(columna, []):
+            if callable(sql):
+                sql(conn)
+            else:
+                cursor.execute(sql)
+    # Después de los rellenos de columnas, de los que dependen (id_cliente, fecha_int)
+    rellenar_agregados(conn)
+    recalcular_fechas(conn)
+    for indice in INDICES_OBSOLETOS:
+        cursor.execute(f"DROP INDEX IF EXISTS {indice}")
+    for trigger in TRIGGERS_OBSOLETOS:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    conn.commit()
+    conn.close()
+
 if __name__ == "__main__":
-    setup_database()
+    if os.path.exists('aml_data.db'):
+        actualizar_esquema()
+    else:
+        setup_database()
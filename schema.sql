@@ -3,13 +3,32 @@ CREATE TABLE IF NOT EXISTS cargas (
     codigo_carga TEXT UNIQUE NOT NULL,
     fecha_carga TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     archivo_origen TEXT,
-    registros_totales INTEGER
+    registros_totales INTEGER,
+    estado TEXT DEFAULT 'COMPLETA',
+    filas_confirmadas INTEGER DEFAULT 0,
+    duplicados INTEGER DEFAULT 0,
+    huella_archivo TEXT
 );
 
+-- Directorio de clientes: atributos en texto de la última carga, para buscar involucrados sin recorrer transacciones
+CREATE TABLE IF NOT EXISTS clientes (
+    id_cliente INTEGER PRIMARY KEY,
+    codunicocli_13_enc TEXT UNIQUE NOT NULL,
+    destipdocumento TEXT,
+    destipbanca TEXT,
+    segmento TEXT,
+    act_economica TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_clientes_act_economica ON clientes(act_economica, codunicocli_13_enc);
+CREATE INDEX IF NOT EXISTS idx_clientes_segmento ON clientes(segmento, codunicocli_13_enc);
+CREATE INDEX IF NOT EXISTS idx_clientes_destipbanca ON clientes(destipbanca, codunicocli_13_enc);
+
 CREATE TABLE IF NOT EXISTS transacciones (
     id_transaccion INTEGER PRIMARY KEY AUTOINCREMENT,
     id_carga INTEGER NOT NULL,
     codunicocli_13_enc TEXT NOT NULL,
+    id_cliente INTEGER,
     tipo_marca TEXT,
     delito TEXT,
     destipdocumento TEXT,
@@ -38,14 +57,101 @@ CREATE TABLE IF NOT EXISTS transacciones (
     operador TEXT,
     numsecuencial TEXT,
     numreg TEXT,
+    hash_natural INTEGER,
+    ts_epoch INTEGER,
+    fecha_int INTEGER,
+    segundos_dia INTEGER,
+    fecha_hora_valida INTEGER DEFAULT 0,
+    fecapertura_int INTEGER,
+    feccierre_int INTEGER,
+    duplicado INTEGER DEFAULT 0,
+    FOREIGN KEY (id_carga) REFERENCES cargas(id_carga) ON DELETE CASCADE,
+    FOREIGN KEY (id_cliente) REFERENCES clientes(id_cliente)
+);
+
+-- Lectura de casos: id_cliente por igualdad, rango de fecha y el resto de filtros resueltos en el índice
+CREATE INDEX IF NOT EXISTS idx_cliente_fecha ON transacciones(id_cliente, fecha, monto, moneda, i_e, segmento, destipdocumento, duplicado);
+CREATE INDEX IF NOT EXISTS idx_carga ON transacciones(id_carga);
+CREATE INDEX IF NOT EXISTS idx_fecha ON transacciones(fecha);
+CREATE INDEX IF NOT EXISTS idx_monto ON transacciones(monto);
+CREATE INDEX IF NOT EXISTS idx_glosa ON transacciones(glosa_limpia);
+CREATE INDEX IF NOT EXISTS idx_hash_natural ON transacciones(hash_natural);
+
+-- Totales por cliente y día (con i_e, grupo, canal, moneda y atributos de filtro), mantenidos al cerrar cada carga
+CREATE TABLE IF NOT EXISTS resumen_diario (
+    id_carga INTEGER NOT NULL,
+    id_cliente INTEGER,
+    fecha DATE,
+    fecha_int INTEGER,
+    i_e TEXT,
+    grupo TEXT,
+    canal TEXT,
+    moneda TEXT,
+    segmento TEXT,
+    destipdocumento TEXT,
+    act_economica TEXT,
+    operaciones INTEGER NOT NULL,
+    monto_total REAL,
+    monto_min REAL,
+    monto_max REAL,
     FOREIGN KEY (id_carga) REFERENCES cargas(id_carga) ON DELETE CASCADE
 );
 
-CREATE INDEX idx_cliente ON transacciones(codunicocli_13_enc);
-CREATE INDEX idx_carga ON transacciones(id_carga);
-CREATE INDEX idx_fecha ON transacciones(fecha);
-CREATE INDEX idx_monto ON transacciones(monto);
-CREATE INDEX idx_glosa ON transacciones(glosa_limpia);
+CREATE INDEX IF NOT EXISTS idx_resumen_cliente_fecha ON resumen_diario(id_cliente, fecha);
+CREATE INDEX IF NOT EXISTS idx_resumen_carga ON resumen_diario(id_carga);
+
+-- Cubo mensual de toda la base por dimensiones de reporte (sin cliente), mantenido al cerrar cada carga
+CREATE TABLE IF NOT EXISTS cubo_mensual (
+    id_carga INTEGER NOT NULL,
+    mes INTEGER,
+    canal TEXT,
+    grupo TEXT,
+    agencia TEXT,
+    operador TEXT,
+    act_economica TEXT,
+    segmento TEXT,
+    moneda TEXT,
+    i_e TEXT,
+    tipo_marca TEXT,
+    delito TEXT,
+    destipdocumento TEXT,
+    operaciones INTEGER NOT NULL,
+    monto_total REAL,
+    FOREIGN KEY (id_carga) REFERENCES cargas(id_carga) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_cubo_carga ON cubo_mensual(id_carga);
+
+-- Catálogo mantenido al cerrar cada carga: totales por carga y valores distintos por dimensión
+CREATE TABLE IF NOT EXISTS estadisticas_carga (
+    id_carga INTEGER PRIMARY KEY,
+    filas INTEGER NOT NULL,
+    filas_unicas INTEGER,
+    clientes INTEGER,
+    fecha_min DATE,
+    fecha_max DATE,
+    monto_total REAL,
+    FOREIGN KEY (id_carga) REFERENCES cargas(id_carga) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS catalogo_valores (
+    id_carga INTEGER NOT NULL,
+    dimension TEXT NOT NULL,
+    valor TEXT,
+    filas INTEGER,
+    FOREIGN KEY (id_carga) REFERENCES cargas(id_carga) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_catalogo_dimension ON catalogo_valores(dimension, valor);
+CREATE INDEX IF NOT EXISTS idx_catalogo_carga ON catalogo_valores(id_carga);
+
+CREATE TABLE IF NOT EXISTS dimensiones (
+    dimension TEXT NOT NULL,
+    codigo INTEGER NOT NULL,
+    valor TEXT NOT NULL,
+    PRIMARY KEY (dimension, codigo),
+    UNIQUE (dimension, valor)
+);
 
 CREATE TABLE IF NOT EXISTS casos (
     id_caso INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,11 +165,15 @@ CREATE TABLE IF NOT EXISTS caso_involucrados (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     id_caso INTEGER NOT NULL,
     codunicocli_13_enc TEXT NOT NULL,
+    id_cliente INTEGER,
     fecha_agregado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (id_caso) REFERENCES casos(id_caso) ON DELETE CASCADE,
+    FOREIGN KEY (id_cliente) REFERENCES clientes(id_cliente),
     UNIQUE(id_caso, codunicocli_13_enc)
 );
 
+CREATE INDEX IF NOT EXISTS idx_involucrados_cliente ON caso_involucrados(id_caso, id_cliente);
+
 CREATE TABLE IF NOT EXISTS reportes_generados (
     id_reporte INTEGER PRIMARY KEY AUTOINCREMENT,
     id_caso INTEGER NOT NULL,
@@ -75,6 +185,72 @@ CREATE TABLE IF NOT EXISTS reportes_generados (
     FOREIGN KEY (id_caso) REFERENCES casos(id_caso) ON DELETE CASCADE
 );
 
+-- Perfil del caso para los filtros de análisis; vale mientras coincidan las versiones de datos
+CREATE TABLE IF NOT EXISTS perfil_casos (
+    id_caso INTEGER PRIMARY KEY,
+    version_datos INTEGER NOT NULL,
+    version_caso INTEGER NOT NULL,
+    perfil TEXT NOT NULL,
+    fecha_calculo TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (id_caso) REFERENCES casos(id_caso) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS trabajos_carga (
+    id_trabajo INTEGER PRIMARY KEY AUTOINCREMENT,
+    codigo_carga TEXT NOT NULL,
+    archivos TEXT NOT NULL,
+    opciones TEXT,
+    estado TEXT DEFAULT 'PENDIENTE',
+    progreso REAL DEFAULT 0,
+    filas_procesadas INTEGER DEFAULT 0,
+    filas_por_seg REAL,
+    mensaje TEXT,
+    id_carga INTEGER,
+    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    fecha_inicio TIMESTAMP,
+    fecha_fin TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos_carga(estado, id_trabajo);
+
+-- Contadores de versión para invalidar la caché de lecturas de casos
+CREATE TABLE IF NOT EXISTS versiones_datos (
+    ambito TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_version_cargas_insert AFTER INSERT ON cargas BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('transacciones', 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
+-- Solo cuando una carga entra o sale de COMPLETA: los avances por bloque de una carga en curso no invalidan
+CREATE TRIGGER IF NOT EXISTS trg_version_cargas_estado AFTER UPDATE OF estado ON cargas
+WHEN (COALESCE(OLD.estado, 'COMPLETA') = 'COMPLETA') <> (COALESCE(NEW.estado, 'COMPLETA') = 'COMPLETA') BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('transacciones', 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_version_cargas_delete AFTER DELETE ON cargas BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('transacciones', 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_version_involucrados_insert AFTER INSERT ON caso_involucrados BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('caso:' || NEW.id_caso, 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_version_involucrados_update AFTER UPDATE ON caso_involucrados BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('caso:' || NEW.id_caso, 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_version_involucrados_delete AFTER DELETE ON caso_involucrados BEGIN
+    INSERT INTO versiones_datos (ambito, version) VALUES ('caso:' || OLD.id_caso, 1)
+    ON CONFLICT(ambito) DO UPDATE SET version = version + 1;
+END;
+
 CREATE TABLE IF NOT EXISTS configuracion_sistema (
     clave TEXT PRIMARY KEY,
     valor TEXT,
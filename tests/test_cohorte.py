@@ -0,0 +1,26 @@
+import pytest
+
+import db_setup
+import utils
+from test_filtros_memoria import RAIZ, transacciones_aleatorias
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.chdir(RAIZ)
+    db_path = str(tmp_path / 'prueba.db')
+    db_setup.setup_database(db_path)
+    conn = utils.abrir_conexion(db_path, {'foreign_keys': 'ON'})
+    utils.cargar_datos(transacciones_aleatorias(500), 'C1', conn)
+    yield conn
+    conn.liberar = None
+    conn.close()
+
+def clientes_del_dia(conn, dia):
+    return {fila[0] for fila in conn.execute(
+        "SELECT DISTINCT id_cliente FROM transacciones WHERE date(fecha) = ?", (dia,))}
+
+@pytest.mark.parametrize('hasta', ['2023-02-10', '2023-02-10 23:59:59'])
+def test_hasta_incluye_el_ultimo_dia(conn, hasta):
+    query, params = utils.construir_consulta_cohorte(conn, {'fecha_min': '2023-02-10', 'fecha_max': hasta})
+    cohorte = {fila[0] for fila in conn.execute(query, params)}
+    assert cohorte == clientes_del_dia(conn, '2023-02-10') != set()
@@ -0,0 +1,29 @@
+from io import BytesIO
+
+import pytest
+
+import db_setup
+import utils
+from test_filtros_memoria import RAIZ, transacciones_aleatorias
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.chdir(RAIZ)
+    db_path = str(tmp_path / 'prueba.db')
+    db_setup.setup_database(db_path)
+    conn = utils.abrir_conexion(db_path, {'foreign_keys': 'ON'})
+    yield conn
+    conn.liberar = None
+    conn.close()
+
+@pytest.mark.parametrize('formato', ['%d/%m/%Y', '%Y-%m-%d'])
+def test_csv_detecta_lo_cargado_desde_excel(conn, formato):
+    # Excel trae la fecha tipada; el CSV la trae como texto en el formato de quien lo exportó
+    df = transacciones_aleatorias(300).drop_duplicates(['CTACOMERCIAL', 'Fecha', 'Hora', 'NUMSECUENCIAL', 'NUMREG', 'Monto'])
+    utils.cargar_datos(df, 'EXCEL', conn)
+    
+    csv = df.assign(Fecha=df['Fecha'].dt.strftime(formato)).to_csv(index=False).encode()
+    estadisticas = {}
+    utils.cargar_datos_streaming(BytesIO(csv), 'CSV', conn, estadisticas=estadisticas, nombre='extracto.csv',
+                                 modo_duplicados='omitir')
+    assert estadisticas['duplicados'] == len(df)
@@ -0,0 +1,104 @@
+import os
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+import db_setup
+import utils
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def transacciones_aleatorias(n, semilla=0):
+    r = random.Random(semilla)
+    filas = []
+    for i in range(n):
+        cliente = f"CLI{r.randint(0, 30):05d}"
+        filas.append({
+            'CODUNICOCLI_13_enc': cliente,
+            'TIPO DE MARCA': r.choice(['A', 'B']),
+            'Delito': r.choice(['MINERIA', 'TRATA', None]),
+            'DESTIPDOCUMENTO': r.choice(['DNI', 'RUC']),
+            'DESTIPBANCA': r.choice(['BANCA PERSONAL', 'BANCA EMPRESA']),
+            'SEGMENTO': r.choice(['S1', 'S2', 'S3', None]),
+            'ACT.ECONOMICA': r.choice(['MINERA', 'COMERCIO']),
+            'CTACOMERCIAL': f"CTA{r.randint(0, 50)}",
+            'MONEDA': r.choice(['SOLES', 'DOLARES']),
+            'Fecha': datetime(2023, 1, 1) + timedelta(days=r.randint(0, 60)),
+            'Hora': r.choice(['10:11:12', '23:59:00', '99:99:99']),
+            'Glosa': r.choice(['YAPE 123', 'RETIRO CAJERO 55', None]),
+            'Grupo': r.choice(['YAPE', 'RETIRO', 'TRANSFERENCIA']),
+            'Canal': r.choice(['CAJEROS AUTOMATICOS', 'VENTANILLA']),
+            'Agencia': r.choice(['AG1', 'AG2']),
+            'Monto': r.choice([round(r.uniform(1, 9000), 2), 2500.5, 3000.0, None]),
+            'I / E': r.choice(['Ingreso', 'Egreso']),
+            'OPERADOR': r.choice(['OP1', 'OP2', None]),
+            'NUMSECUENCIAL': str(i),
+            'NUMREG': str(i % 7)
+        })
+    return pd.DataFrame(filas)
+
+def filtros_aleatorios(r, segmentos):
+    return {
+        'moneda': r.choice(['AMBOS', 'SOLES', 'DOLARES']),
+        'tipo_documento': r.choice(['AMBOS', 'DNI', 'RUC']),
+        'ie': r.choice(['AMBOS', 'INGRESO', 'EGRESO']),
+        'segmento': r.sample(segmentos, r.randint(0, len(segmentos))),
+        'monto_min': r.choice([None, 0.0, 100.0, 2500.5]),
+        'monto_max': r.choice([None, 1000000.0, 3000.0]),
+        'fecha_min': r.choice([None, '2016-01-01', '2023-01-15']),
+        'fecha_max': r.choice([None, '2023-02-10', '2023-02-10 00:00:00', '2023-02-10 23:59:59', '2024-01-01'])
+    }
+
+@pytest.fixture(params=[False, True], ids=['texto', 'codificado'])
+def conn(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(RAIZ)
+    db_path = str(tmp_path / 'prueba.db')
+    db_setup.setup_database(db_path)
+    conn = utils.abrir_conexion(db_path, {'foreign_keys': 'ON'})
+    utils.cargar_datos(transacciones_aleatorias(4000), 'C1', conn)
+    if request.param:
+        utils.activar_codificacion_dimensiones(conn)
+    conn.execute("INSERT INTO casos (nombre_caso) VALUES ('prueba')")
+    conn.execute("""
+        INSERT INTO caso_involucrados (id_caso, codunicocli_13_enc, id_cliente)
+        SELECT 1, codunicocli_13_enc, id_cliente FROM clientes WHERE id_cliente % 3 <> 0
+    """)
+    conn.commit()
+    # La caché es global al proceso y la clave no distingue bases: cada prueba parte vacía
+    utils.cache_casos.clear()
+    yield conn
+    utils.cache_casos.clear()
+    conn.execute("PRAGMA wal_checkpoint")
+    conn.liberar = None
+    conn.close()
+
+def test_filtros_en_memoria_igualan_la_lectura_sql(conn):
+    r = random.Random(1)
+    segmentos = ['S1', 'S2', 'S3']
+    for _ in range(60):
+        filtros = filtros_aleatorios(r, segmentos)
+        columnas = r.choice(list(utils.COLUMNAS_ANALISIS.values()))
+        if columnas is not None:
+            columnas = list(dict.fromkeys(['id_transaccion'] + list(columnas)))
+        
+        esperado = utils.obtener_datos_caso(1, conn, filtros, columnas)
+        obtenido = utils.filtrar_caso_memoria(1, conn, filtros, columnas)
+        
+        esperado = esperado.sort_values('id_transaccion').reset_index(drop=True)
+        obtenido = obtenido.sort_values('id_transaccion').reset_index(drop=True)
+        # La lectura SQL agrega al final las columnas derivadas (fecha_dt, feccierre...); el orden no cuenta
+        pd.testing.assert_frame_equal(obtenido, esperado, check_like=True, obj=str(filtros))
+
+def test_sin_filtros_devuelve_todo_el_caso(conn):
+    esperado = utils.obtener_datos_caso(1, conn)
+    obtenido = utils.filtrar_caso_memoria(1, conn)
+    assert len(obtenido) == len(esperado) > 0
+
+def test_plan_de_consulta_corresponde_a_la_lectura_del_caso(conn):
+    for columnas in list(utils.COLUMNAS_ANALISIS.values()) + [None]:
+        plan = utils.diagnosticar_consulta_caso(1, conn, columnas)
+        assert len(plan) > 0
+        # La lectura parte de los involucrados del caso y llega a las transacciones por índice
+        assert not plan['escaneo_completo'].any(), plan['detalle'].tolist()
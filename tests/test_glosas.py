@@ -0,0 +1,13 @@
+import pandas as pd
+
+import utils
+
+def test_memo_de_glosas_acotado(monkeypatch):
+    monkeypatch.setattr(utils, 'MAX_MEMO_GLOSAS', 10)
+    memo = {}
+    for bloque in range(20):
+        serie = pd.Series([f"Pago {bloque * 4 + i}-x" for i in range(6)] * 3 + [None])
+        resultado = utils.limpiar_glosas(serie, memo=memo)
+        # El tope no cambia el resultado: las glosas del bloque siempre quedan en el memo
+        assert resultado.tolist() == [utils.limpiar_glosa(g) for g in serie[:-1]] + ['']
+        assert len(memo) <= 10
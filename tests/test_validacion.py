@@ -0,0 +1,41 @@
+from io import BytesIO
+
+import pandas as pd
+
+import utils
+from test_filtros_memoria import transacciones_aleatorias
+
+def como_archivo(contenido, nombre):
+    archivo = BytesIO(contenido)
+    archivo.name = nombre
+    return archivo
+
+def libro(hojas):
+    salida = BytesIO()
+    with pd.ExcelWriter(salida, engine='openpyxl') as escritor:
+        for nombre, df in hojas.items():
+            df.to_excel(escritor, sheet_name=nombre, index=False)
+    return salida.getvalue()
+
+def test_solo_se_validan_las_hojas_que_se_cargan():
+    contenido = libro({'Datos': transacciones_aleatorias(20), 'Notas': pd.DataFrame({'Comentario': ['x']})})
+    
+    simple = utils.validar_archivo(como_archivo(contenido, 'extracto.xlsx'), 'extracto.xlsx')
+    assert [(v['hoja'], v['faltantes']) for v in simple] == [(None, [])]
+    
+    paralela = utils.validar_archivo(como_archivo(contenido, 'extracto.xlsx'), 'extracto.xlsx', todas_las_hojas=True)
+    assert [v['hoja'] for v in paralela] == ['Datos', 'Notas']
+    assert not paralela[0]['faltantes'] and paralela[1]['faltantes']
+
+def test_montos_en_blanco_son_faltantes():
+    df = transacciones_aleatorias(20)
+    df['Monto'] = df['Monto'].astype(object)
+    df.loc[[0, 1], 'Monto'] = ['', '   ']
+    contenido = df.to_csv(index=False).encode()
+    
+    validacion, = utils.validar_archivo(como_archivo(contenido, 'extracto.csv'), 'extracto.csv')
+    assert validacion['problemas'] == []
+    
+    df.loc[2, 'Monto'] = 'abc'
+    validacion, = utils.validar_archivo(como_archivo(df.to_csv(index=False).encode(), 'extracto.csv'), 'extracto.csv')
+    assert len(validacion['problemas']) == 1
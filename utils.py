@@ -2,7 +2,7 @@ import pandas as pd
 import numpy as np
 import re
 import sqlite3
-from datetime import datetime
+from datetime import datetime, date, time as dtime
 import plotly.graph_objects as go
 import plotly.express as px
 import networkx as nx
@@ -14,6 +14,19 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak,
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
 import math
+import time
+import os
+import json
+import hashlib
+import queue
+import threading
+import multiprocessing
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from openpyxl import load_workbook
 
 def limpiar_glosa(glosa):
     if pd.isna(glosa):
@@ -24,87 +37,1837 @@ def limpiar_glosa(glosa):
     glosa_limpia = ' '.join(glosa_limpia.split())
     return glosa_limpia.upper()
 
-def cargar_datos(df, codigo_carga, conn, progress_callback=None):
+# Tope de valores en el memo de glosas que se comparte entre los bloques de una carga. Al superarlo se
+# conservan solo las glosas del bloque actual; las que reaparecen después se vuelven a limpiar
+MAX_MEMO_GLOSAS = 100000
+
+def limpiar_glosas(serie, memo=None, estadisticas=None):
+    # Las glosas se repiten mucho: se limpia cada valor distinto una sola vez y se mapea al resto
+    inicio = time.perf_counter()
+    if memo is None:
+        memo = {}
+    
+    unicas = serie.dropna().unique()
+    nuevas = [valor for valor in unicas if valor not in memo]
+    if len(memo) + len(nuevas) > MAX_MEMO_GLOSAS:
+        vigentes = {valor: memo[valor] for valor in unicas if valor in memo}
+        memo.clear()
+        memo.update(vigentes)
+    for valor in nuevas:
+        memo[valor] = limpiar_glosa(valor)
+    
+    resultado = serie.map(memo).fillna("")
+    
+    if estadisticas is not None:
+        estadisticas['filas'] = estadisticas.get('filas', 0) + len(serie)
+        estadisticas['glosas_unicas'] = estadisticas.get('glosas_unicas', 0) + len(nuevas)
+        estadisticas['segundos_limpieza'] = estadisticas.get('segundos_limpieza', 0.0) + (time.perf_counter() - inicio)
+        estadisticas['ratio_dedup'] = estadisticas['filas'] / max(estadisticas['glosas_unicas'], 1)
+        estadisticas['filas_por_seg'] = estadisticas['filas'] / max(estadisticas['segundos_limpieza'], 1e-9)
+    
+    return resultado
+
+COLUMNAS_REQUERIDAS = [
+    'CODUNICOCLI_13_enc', 'TIPO DE MARCA', 'DESTIPDOCUMENTO',
+    'DESTIPBANCA', 'SEGMENTO', 'ACT.ECONOMICA', 'Fecha', 'Monto', 'I / E'
+]
+
+COLUMNAS_MAP = {
+    'CODUNICOCLI_13_enc': 'codunicocli_13_enc',
+    'TIPO DE MARCA': 'tipo_marca',
+    'Delito': 'delito',
+    'DESTIPDOCUMENTO': 'destipdocumento',
+    'DESTIPBANCA': 'destipbanca',
+    'SEGMENTO': 'segmento',
+    'ACT.ECONOMICA': 'act_economica',
+    'CODUNICOCLI_13': 'codunicocli_13',
+    'CTACOMERCIAL': 'ctacomercial',
+    'CODPRODUCTO': 'codproducto',
+    'MONEDA': 'moneda',
+    'FECAPERTURA': 'fecapertura',
+    'FECCIERRE': 'feccierre',
+    'MTOAPERTURA': 'mtoapertura',
+    'Fecha': 'fecha',
+    'Hora': 'hora',
+    'FechaProc': 'fechaproc',
+    'Glosa': 'glosa',
+    'glosa_limpia': 'glosa_limpia',
+    'Grupo': 'grupo',
+    'Canal': 'canal',
+    'CodAgencia': 'codagencia',
+    'Agencia': 'agencia',
+    'Monto': 'monto',
+    'I / E': 'i_e',
+    'TERMINAL': 'terminal',
+    'OPERADOR': 'operador',
+    'NUMSECUENCIAL': 'numsecuencial',
+    'NUMREG': 'numreg'
+}
+
+def preparar_transacciones(df, id_carga, memo_glosas=None, estadisticas=None):
+    df = df.copy()
+    if 'Glosa' in df.columns:
+        df['glosa_limpia'] = limpiar_glosas(df['Glosa'], memo=memo_glosas, estadisticas=estadisticas)
+    
+    df_insert = df.rename(columns=COLUMNAS_MAP)
+    df_insert['id_carga'] = id_carga
+    df_insert['hash_natural'] = calcular_hash_natural(df_insert)
+    df_insert = pd.concat([df_insert, calcular_marcas_tiempo(df_insert)], axis=1)
+    
+    columnas_db = (['id_carga'] + [v for v in COLUMNAS_MAP.values() if v in df_insert.columns] +
+                   ['hash_natural'] + COLUMNAS_TIEMPO)
+    return df_insert[columnas_db]
+
+COLUMNAS_TIEMPO = ['ts_epoch', 'fecha_int', 'segundos_dia', 'fecha_hora_valida', 'fecapertura_int', 'feccierre_int']
+
+def parsear_fechas(serie):
+    # ISO primero (camino rápido); lo que no calce se intenta con inferencia, día primero (dd/mm/aaaa)
+    texto = texto_clave(serie).str[:10]
+    fechas = pd.to_datetime(texto, format='%Y-%m-%d', errors='coerce')
+    pendientes = fechas.isna() & (texto != '')
+    if pendientes.any():
+        otras = pd.to_datetime(serie[pendientes].astype(str), format='mixed', dayfirst=True, errors='coerce')
+        fechas = fechas.where(~pendientes, otras)
+    return fechas
+
+def fecha_a_entero(fechas):
+    return (fechas.dt.year * 10000 + fechas.dt.month * 100 + fechas.dt.day).astype('Int64')
+
+def parsear_horas(serie):
+    # Segundos desde medianoche; horas inválidas (p. ej. 99:99:99) quedan nulas
+    texto = normalizar_clave(serie, 'hora').str.split(' ').str[-1]
+    partes = texto.str.extract(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?').astype(float)
+    h, m, s = partes[0], partes[1], partes[2].fillna(0)
+    validas = (h < 24) & (m < 60) & (s < 60)
+    return (h * 3600 + m * 60 + s).where(validas).astype('Int64')
+
+def calcular_marcas_tiempo(df_insert):
+    marcas = pd.DataFrame(index=df_insert.index)
+    vacia = pd.Series(pd.NaT, index=df_insert.index, dtype='datetime64[s]')
+    
+    fechas = parsear_fechas(df_insert['fecha']) if 'fecha' in df_insert.columns else vacia
+    segundos = parsear_horas(df_insert['hora']) if 'hora' in df_insert.columns else pd.Series(pd.NA, index=df_insert.index, dtype='Int64')
+    
+    dias = (fechas - pd.Timestamp('1970-01-01')) // pd.Timedelta(days=1)
+    marcas['ts_epoch'] = (dias.astype('Int64') * 86400 + segundos).astype('Int64')
+    marcas['fecha_int'] = fecha_a_entero(fechas)
+    marcas['segundos_dia'] = segundos
+    marcas['fecha_hora_valida'] = marcas['ts_epoch'].notna().astype(int)
+    for col in ['fecapertura', 'feccierre']:
+        marcas[f'{col}_int'] = fecha_a_entero(parsear_fechas(df_insert[col]) if col in df_insert.columns else vacia)
+    return marcas
+
+def entero_a_fecha(serie):
+    serie = pd.to_numeric(serie, errors='coerce')
+    return pd.to_datetime(pd.DataFrame({'year': serie // 10000, 'month': serie // 100 % 100, 'day': serie % 100}),
+                          errors='coerce')
+
+# Columnas derivadas que entrega obtener_datos_caso y la columna guardada de la que salen
+COLUMNAS_DERIVADAS = {
+    'fecha_dt': 'fecha_int',
+    'fecha_hora': 'ts_epoch',
+    'hora_num': 'segundos_dia',
+    'fecapertura': 'fecapertura_int',
+    'feccierre': 'feccierre_int'
+}
+
+def agregar_columnas_tiempo(df):
+    # Columnas datetime64 listas para los análisis, a partir de lo parseado en la carga
+    if 'fecha_int' in df.columns:
+        df['fecha_dt'] = entero_a_fecha(df['fecha_int'])
+    if 'ts_epoch' in df.columns:
+        df['fecha_hora'] = pd.to_datetime(pd.to_numeric(df['ts_epoch'], errors='coerce'), unit='s')
+    if 'segundos_dia' in df.columns:
+        df['hora_num'] = (pd.to_numeric(df['segundos_dia'], errors='coerce') // 3600).astype('Int64')
+    if 'fecapertura_int' in df.columns:
+        df['fecapertura'] = entero_a_fecha(df['fecapertura_int'])
+    if 'feccierre_int' in df.columns:
+        df['feccierre'] = entero_a_fecha(df['feccierre_int'])
+    return df.drop(columns=[col for col in COLUMNAS_TIEMPO if col in df.columns])
+
+COLUMNAS_CLAVE_NATURAL = ['ctacomercial', 'fecha', 'hora', 'numsecuencial', 'numreg', 'monto']
+
+def texto_clave(serie):
+    # La misma transacción puede llegar como Excel (fechas/números tipados) o CSV (texto)
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        serie = serie.dt.strftime('%Y-%m-%d %H:%M:%S')
+    texto = serie.astype(object).where(serie.notna(), '').map(str)
+    return texto.str.replace(r'\.0$', '', regex=True).astype(object)
+
+def normalizar_clave(serie, columna):
+    if columna == 'monto':
+        return pd.to_numeric(serie, errors='coerce').round(2).map('{:.2f}'.format).astype(object)
+    if columna == 'fecha':
+        # La fecha ya parseada: 10/02/2023 (CSV) y 2023-02-10 (Excel) dan la misma clave
+        fechas = parsear_fechas(serie)
+        return fechas.dt.strftime('%Y-%m-%d').where(fechas.notna(), texto_clave(serie)).astype(object)
+    return texto_clave(serie)
+
+def calcular_hash_natural(df_insert):
+    clave = pd.Series('', index=df_insert.index, dtype=object)
+    for col in COLUMNAS_CLAVE_NATURAL:
+        valores = normalizar_clave(df_insert[col], col) if col in df_insert.columns else ''
+        clave = clave + '|' + valores
+    return pd.util.hash_array(clave.to_numpy(dtype=object)).view('int64')
+
+def filtrar_duplicados(df_insert, conn, modo='omitir'):
+    # Una sola consulta por bloque: los hashes van a una tabla temporal y se cruzan contra el índice
+    if not modo:
+        return df_insert, 0
+    
+    repetido = df_insert['hash_natural'].duplicated()
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS hashes_bloque (hash INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.hashes_bloque")
+    conn.executemany("INSERT INTO temp.hashes_bloque (hash) VALUES (?)",
+                     ((int(h),) for h in df_insert.loc[~repetido, 'hash_natural']))
+    existentes = {fila[0] for fila in conn.execute("""
+        SELECT h.hash FROM temp.hashes_bloque h
+        WHERE EXISTS (SELECT 1 FROM transacciones t WHERE t.hash_natural = h.hash)
+    """)}
+    
+    duplicado = repetido | df_insert['hash_natural'].isin(existentes)
+    num_duplicados = int(duplicado.sum())
+    
+    if modo == 'marcar':
+        df_insert = df_insert.copy()
+        df_insert['duplicado'] = duplicado.astype(int)
+        return df_insert, num_duplicados
+    return df_insert[~duplicado], num_duplicados
+
+# idx_hash_natural queda fuera a propósito: la detección de duplicados lo usa durante la carga
+INDICES_TRANSACCIONES = {
+    'idx_cliente_fecha': "CREATE INDEX IF NOT EXISTS idx_cliente_fecha ON transacciones(id_cliente, fecha, monto, moneda, i_e, segmento, destipdocumento, duplicado)",
+    'idx_carga': "CREATE INDEX IF NOT EXISTS idx_carga ON transacciones(id_carga)",
+    'idx_fecha': "CREATE INDEX IF NOT EXISTS idx_fecha ON transacciones(fecha)",
+    'idx_monto': "CREATE INDEX IF NOT EXISTS idx_monto ON transacciones(monto)",
+    'idx_glosa': "CREATE INDEX IF NOT EXISTS idx_glosa ON transacciones(glosa_limpia)"
+}
+
+# Perfil para cargas masivas: synchronous=OFF prioriza velocidad sobre durabilidad, por lo que conviene
+# respaldar la base antes de cargas muy grandes. El journal se mantiene en WAL para no bloquear a los
+# lectores; solo se espacian los checkpoints mientras dura la carga
+PRAGMAS_CARGA_MASIVA = {
+    'synchronous': 'OFF',
+    'wal_autocheckpoint': 10000,
+    'cache_size': -262144,
+    'temp_store': 'MEMORY'
+}
+
+# Las cargas reanudables confirman bloque a bloque, por lo que mantienen un journal seguro ante caídas
+PRAGMAS_CARGA_REANUDABLE = {
+    'synchronous': 'NORMAL',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY'
+}
+
+@contextmanager
+def pragmas_carga_masiva(conn, pragmas=None):
+    pragmas = pragmas or PRAGMAS_CARGA_MASIVA
+    previos = {nombre: conn.execute(f"PRAGMA {nombre}").fetchone()[0] for nombre in pragmas}
+    for nombre, valor in pragmas.items():
+        conn.execute(f"PRAGMA {nombre} = {valor}")
+    try:
+        yield
+    finally:
+        for nombre, valor in previos.items():
+            try:
+                conn.execute(f"PRAGMA {nombre} = {valor}")
+            except sqlite3.OperationalError:
+                pass
+
+# Administrador de conexiones: la base trabaja en WAL, de modo que los lectores no se bloquean con las
+# escrituras. Las lecturas toman conexiones de un pool y todas las escrituras de la aplicación pasan por
+# una única conexión serializada con un lock por proceso
+PRAGMAS_LECTURA = {
+    'foreign_keys': 'ON',
+    'query_only': 'ON',
+    'mmap_size': 268435456,
+    'cache_size': -65536,
+    'temp_store': 'MEMORY'
+}
+
+PRAGMAS_ESCRITURA = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 60000,
+    'mmap_size': 268435456,
+    'cache_size': -131072,
+    'temp_store': 'MEMORY'
+}
+
+MAX_LECTORES_POOL = 8
+
+class ConexionAdministrada(sqlite3.Connection):
+    # close() devuelve la conexión a su administrador en lugar de cerrarla
+    liberar = None
+
+    def close(self):
+        liberar, self.liberar = self.liberar, None
+        if liberar is not None:
+            liberar(self)
+
+def abrir_conexion(db_path, pragmas):
+    conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, factory=ConexionAdministrada)
+    for nombre, valor in pragmas.items():
+        conn.execute(f"PRAGMA {nombre} = {valor}").fetchall()
+    return conn
+
+pool_lectores = {}
+escritores = {}
+bloqueo_conexiones = threading.Lock()
+
+def conexion_lectura(db_path):
+    with bloqueo_conexiones:
+        pool = pool_lectores.setdefault(db_path, queue.LifoQueue())
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = abrir_conexion(db_path, PRAGMAS_LECTURA)
+    conn.liberar = lambda c: devolver_lectura(c, pool)
+    return conn
+
+def devolver_lectura(conn, pool):
+    conn.rollback()
+    if pool.qsize() < MAX_LECTORES_POOL:
+        pool.put(conn)
+    else:
+        sqlite3.Connection.close(conn)
+
+def escritor_compartido(db_path):
+    with bloqueo_conexiones:
+        if db_path not in escritores:
+            escritores[db_path] = (abrir_conexion(db_path, PRAGMAS_ESCRITURA), threading.Lock())
+        return escritores[db_path]
+
+def conexion_escritura(db_path, esperar=True):
+    # Bloquea hasta que la escritura en curso de otra sesión termine (o devuelve None si esperar=False
+    # y el escritor está ocupado); close() deshace lo no confirmado y libera el turno
+    conn, bloqueo = escritor_compartido(db_path)
+    if not bloqueo.acquire(blocking=esperar):
+        return None
+    conn.liberar = lambda c: liberar_escritura(c, bloqueo)
+    return conn
+
+def liberar_escritura(conn, bloqueo):
+    try:
+        conn.rollback()
+    finally:
+        bloqueo.release()
+
+@contextmanager
+def turno_escritura(db_path):
+    # Solo el turno del escritor, para quien escribe con una conexión propia (el procesador de cargas):
+    # cada transacción se confirma dentro del turno, así las escrituras de la aplicación esperan a lo
+    # sumo un bloque
+    with escritor_compartido(db_path)[1]:
+        yield
+
+@contextmanager
+def transaccion_escritura(db_path):
+    conn = conexion_escritura(db_path)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def eliminar_indices_transacciones(conn):
+    for nombre in INDICES_TRANSACCIONES:
+        conn.execute(f"DROP INDEX IF EXISTS {nombre}")
+
+def crear_indices_transacciones(conn):
+    for ddl in INDICES_TRANSACCIONES.values():
+        conn.execute(ddl)
+
+def filas_sqlite(df):
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        elif df[col].dtype == object:
+            df[col] = df[col].map(lambda v: str(v) if isinstance(v, (date, dtime)) else v)
+    df = df.astype(object).where(df.notna(), None)
+    return df.itertuples(index=False, name=None)
+
+def insertar_transacciones(df_insert, conn):
+    # Siempre executemany: to_sql confirma por su cuenta y dejaría cargas a medias al fallar un bloque
+    columnas = list(df_insert.columns)
+    sql = f"INSERT INTO transacciones ({', '.join(columnas)}) VALUES ({', '.join(['?'] * len(columnas))})"
+    conn.executemany(sql, filas_sqlite(df_insert))
+    return len(df_insert)
+
+def registrar_tiempo_insercion(estadisticas, filas, segundos):
+    if estadisticas is None:
+        return
+    estadisticas['filas_insertadas'] = estadisticas.get('filas_insertadas', 0) + filas
+    estadisticas['segundos_insercion'] = estadisticas.get('segundos_insercion', 0.0) + segundos
+    estadisticas['filas_por_seg_insercion'] = estadisticas['filas_insertadas'] / max(estadisticas['segundos_insercion'], 1e-9)
+
+COLUMNAS_DIMENSION = ['canal', 'grupo', 'agencia', 'segmento', 'act_economica', 'destipbanca',
+                      'moneda', 'i_e', 'tipo_marca', 'delito']
+
+def dimensiones_codificadas(conn):
+    fila = conn.execute("SELECT valor FROM configuracion_sistema WHERE clave = 'dimensiones_codificadas'").fetchone()
+    return bool(fila and fila[0] == '1')
+
+def obtener_dimensiones(conn):
+    # Valores de cada dimensión ordenados por código (los códigos son 0..n-1 por dimensión)
+    dimensiones = {col: [] for col in COLUMNAS_DIMENSION}
+    for dimension, valor in conn.execute("SELECT dimension, valor FROM dimensiones ORDER BY dimension, codigo"):
+        dimensiones.setdefault(dimension, []).append(valor)
+    return dimensiones
+
+def obtener_codigos_dimensiones(conn):
+    return {col: {valor: codigo for codigo, valor in enumerate(valores)}
+            for col, valores in obtener_dimensiones(conn).items()}
+
+def valor_almacenado(codigos, columna, valor):
+    if codigos is None or columna not in codigos:
+        return valor
+    return codigos[columna].get(valor, -1)
+
+def codificar_dimensiones_bloque(df_insert, conn):
+    df_insert = df_insert.copy()
+    for col in COLUMNAS_DIMENSION:
+        if col not in df_insert.columns:
+            continue
+        texto = df_insert[col].astype(object).where(df_insert[col].notna(), None).map(
+            lambda v: v if v is None else str(v))
+        
+        codigos = dict(conn.execute("SELECT valor, codigo FROM dimensiones WHERE dimension = ?", (col,)))
+        nuevos = [v for v in texto.dropna().unique() if v not in codigos]
+        if nuevos:
+            inicio = len(codigos)
+            filas = [(col, inicio + i, valor) for i, valor in enumerate(nuevos)]
+            conn.executemany("INSERT INTO dimensiones (dimension, codigo, valor) VALUES (?, ?, ?)", filas)
+            codigos.update({valor: codigo for _, codigo, valor in filas})
+        
+        df_insert[col] = texto.map(codigos).astype('Int64')
+    return df_insert
+
+def decodificar_dimensiones(df, conn):
+    dimensiones = obtener_dimensiones(conn)
+    for col in COLUMNAS_DIMENSION:
+        if col in df.columns:
+            codigos = pd.to_numeric(df[col], errors='coerce').fillna(-1).astype(int)
+            df[col] = pd.Categorical.from_codes(codigos, categories=dimensiones[col]).remove_unused_categories()
+    return df
+
+def activar_codificacion_dimensiones(conn, compactar=False):
+    # Convierte una sola vez las filas existentes; las cargas posteriores se codifican al insertar
+    if dimensiones_codificadas(conn):
+        return
+    try:
+        for col in COLUMNAS_DIMENSION:
+            inicio = conn.execute("SELECT COUNT(*) FROM dimensiones WHERE dimension = ?", (col,)).fetchone()[0]
+            conn.execute(f"""
+                INSERT INTO dimensiones (dimension, codigo, valor)
+                SELECT ?, ? + ROW_NUMBER() OVER (ORDER BY valor) - 1, valor
+                FROM (SELECT DISTINCT CAST({col} AS TEXT) AS valor FROM transacciones WHERE {col} IS NOT NULL)
+                WHERE valor NOT IN (SELECT valor FROM dimensiones WHERE dimension = ?)
+            """, (col, inicio, col))
+            conn.execute(f"""
+                UPDATE transacciones SET {col} = (
+                    SELECT d.codigo FROM dimensiones d
+                    WHERE d.dimension = ? AND d.valor = CAST(transacciones.{col} AS TEXT)
+                )
+                WHERE {col} IS NOT NULL
+            """, (col,))
+        reconstruir_agregados(conn)
+        conn.execute("""
+            INSERT OR REPLACE INTO configuracion_sistema (clave, valor, descripcion)
+            VALUES ('dimensiones_codificadas', '1', 'Columnas de baja cardinalidad guardadas como códigos de la tabla dimensiones')
+        """)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    
+    if compactar:
+        conn.execute("VACUUM")
+
+# Atributos del directorio de clientes, guardados siempre como texto (la última carga manda)
+ATRIBUTOS_CLIENTE = ['destipdocumento', 'destipbanca', 'segmento', 'act_economica']
+
+def asignar_id_cliente(df_insert, conn):
+    # Alta de clientes nuevos, actualización del directorio y resolución de ids con una sola consulta por bloque
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS clientes_bloque (codigo TEXT PRIMARY KEY, {', '.join(ATRIBUTOS_CLIENTE)})")
+    conn.execute("DELETE FROM temp.clientes_bloque")
+    atributos = [col for col in ATRIBUTOS_CLIENTE if col in df_insert.columns]
+    df_clientes = df_insert.dropna(subset=['codunicocli_13_enc']).drop_duplicates('codunicocli_13_enc', keep='last')
+    filas = zip(df_clientes['codunicocli_13_enc'].astype(str),
+                *(df_clientes[col].astype(object).where(df_clientes[col].notna(), None) for col in atributos))
+    conn.executemany(f"INSERT INTO temp.clientes_bloque (codigo{''.join(', ' + col for col in atributos)}) "
+                     f"VALUES ({', '.join(['?'] * (len(atributos) + 1))})", filas)
+    conn.execute(f"""
+        INSERT INTO clientes (codunicocli_13_enc, {', '.join(ATRIBUTOS_CLIENTE)})
+        SELECT codigo, {', '.join(ATRIBUTOS_CLIENTE)} FROM temp.clientes_bloque WHERE true
+        ON CONFLICT (codunicocli_13_enc) DO UPDATE SET
+        {', '.join(f"{col} = COALESCE(excluded.{col}, {col})" for col in ATRIBUTOS_CLIENTE)}
+    """)
+    ids = dict(conn.execute("""
+        SELECT c.codunicocli_13_enc, c.id_cliente
+        FROM clientes c INNER JOIN temp.clientes_bloque b ON b.codigo = c.codunicocli_13_enc
+    """))
+    
+    df_insert = df_insert.copy()
+    df_insert['id_cliente'] = df_insert['codunicocli_13_enc'].astype(str).map(ids).astype('Int64')
+    return df_insert
+
+def escribir_bloque(df_insert, conn, modo_duplicados=None, estadisticas=None):
+    df_insert, num_duplicados = filtrar_duplicados(df_insert, conn, modo_duplicados)
+    df_insert = asignar_id_cliente(df_insert, conn)
+    if dimensiones_codificadas(conn):
+        df_insert = codificar_dimensiones_bloque(df_insert, conn)
+    
+    inicio = time.perf_counter()
+    insertar_transacciones(df_insert, conn)
+    registrar_tiempo_insercion(estadisticas, len(df_insert), time.perf_counter() - inicio)
+    
+    if estadisticas is not None:
+        estadisticas['duplicados'] = estadisticas.get('duplicados', 0) + num_duplicados
+    return num_duplicados
+
+def cargar_datos(df, codigo_carga, conn, progress_callback=None, estadisticas=None,
+                 masivo=False, reconstruir_indices=False, modo_duplicados=None):
+    with (pragmas_carga_masiva(conn) if masivo else nullcontext()):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO cargas (codigo_carga, registros_totales) VALUES (?, ?)",
+                           (codigo_carga, len(df)))
+            id_carga = cursor.lastrowid
+            
+            df_insert = preparar_transacciones(df, id_carga, estadisticas=estadisticas)
+            
+            if reconstruir_indices:
+                eliminar_indices_transacciones(conn)
+            
+            chunk_size = 5000
+            total_rows = len(df_insert)
+            num_chunks = math.ceil(total_rows / chunk_size)
+            duplicados = 0
+            
+            for i in range(num_chunks):
+                start_idx = i * chunk_size
+                end_idx = start_idx + chunk_size
+                chunk = df_insert.iloc[start_idx:end_idx]
+                
+                duplicados += escribir_bloque(chunk, conn, modo_duplicados=modo_duplicados,
+                                              estadisticas=estadisticas)
+                
+                if progress_callback:
+                    progress_callback((i + 1) / num_chunks)
+            
+            if reconstruir_indices:
+                crear_indices_transacciones(conn)
+            
+            actualizar_agregados_carga(conn, id_carga)
+            cursor.execute("UPDATE cargas SET duplicados = ? WHERE id_carga = ?", (duplicados, id_carga))
+            conn.commit()
+            return id_carga
+
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+def listar_hojas_excel(archivo):
+    wb = load_workbook(archivo, read_only=True)
     try:
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO cargas (codigo_carga, registros_totales) VALUES (?, ?)",
-                       (codigo_carga, len(df)))
-        id_carga = cursor.lastrowid
+        hojas = wb.sheetnames
+    finally:
+        wb.close()
+    if hasattr(archivo, 'seek'):
+        archivo.seek(0)
+    return hojas
+
+def leer_excel_por_bloques(archivo, chunk_size=5000, hoja=None, saltar_filas=0):
+    # Lectura incremental (read_only) para no materializar el libro completo en memoria
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        ws = wb[hoja] if hoja else wb.worksheets[0]
+        filas = ws.iter_rows(values_only=True)
         
-        df['glosa_limpia'] = df['Glosa'].apply(limpiar_glosa)
+        encabezado = next(filas, None)
+        if encabezado is None:
+            return
+        columnas = [str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(encabezado)]
         
-        columnas_map = {
-            'CODUNICOCLI_13_enc': 'codunicocli_13_enc',
-            'TIPO DE MARCA': 'tipo_marca',
-            'Delito': 'delito',
-            'DESTIPDOCUMENTO': 'destipdocumento',
-            'DESTIPBANCA': 'destipbanca',
-            'SEGMENTO': 'segmento',
-            'ACT.ECONOMICA': 'act_economica',
-            'CODUNICOCLI_13': 'codunicocli_13',
-            'CTACOMERCIAL': 'ctacomercial',
-            'CODPRODUCTO': 'codproducto',
-            'MONEDA': 'moneda',
-            'FECAPERTURA': 'fecapertura',
-            'FECCIERRE': 'feccierre',
-            'MTOAPERTURA': 'mtoapertura',
-            'Fecha': 'fecha',
-            'Hora': 'hora',
-            'FechaProc': 'fechaproc',
-            'Glosa': 'glosa',
-            'glosa_limpia': 'glosa_limpia',
-            'Grupo': 'grupo',
-            'Canal': 'canal',
-            'CodAgencia': 'codagencia',
-            'Agencia': 'agencia',
-            'Monto': 'monto',
-            'I / E': 'i_e',
-            'TERMINAL': 'terminal',
-            'OPERADOR': 'operador',
-            'NUMSECUENCIAL': 'numsecuencial',
-            'NUMREG': 'numreg'
-        }
+        bloque = []
+        for fila in filas:
+            if all(v is None for v in fila):
+                continue
+            if saltar_filas:
+                saltar_filas -= 1
+                continue
+            bloque.append(fila[:len(columnas)])
+            if len(bloque) >= chunk_size:
+                yield pd.DataFrame(bloque, columns=columnas)
+                bloque = []
         
-        df_insert = df.rename(columns=columnas_map)
-        df_insert['id_carga'] = id_carga
+        if bloque:
+            yield pd.DataFrame(bloque, columns=columnas)
+    finally:
+        wb.close()
+
+def estimar_filas_excel(archivo, hoja=None):
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        max_row = (wb[hoja] if hoja else wb.worksheets[0]).max_row
+    finally:
+        wb.close()
+    if hasattr(archivo, 'seek'):
+        archivo.seek(0)
+    return max(max_row - 1, 0) if max_row else None
+
+COLUMNAS_NUMERICAS = ['Monto', 'MTOAPERTURA']
+
+def tipo_archivo(nombre):
+    extension = os.path.splitext(nombre or '')[1].lower()
+    if extension in ('.csv', '.txt'):
+        return 'csv'
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    return 'xlsx'
+
+def detectar_separador_csv(archivo):
+    linea = archivo.readline()
+    archivo.seek(0)
+    if isinstance(linea, bytes):
+        linea = linea.decode('utf-8', errors='ignore')
+    return ';' if linea.count(';') > linea.count(',') else ','
+
+def leer_csv_por_bloques(archivo, chunk_size=5000, encoding='utf-8-sig'):
+    # Todo se lee como texto (códigos con ceros a la izquierda) salvo los montos
+    sep = detectar_separador_csv(archivo)
+    for chunk in pd.read_csv(archivo, sep=sep, dtype=str, chunksize=chunk_size, encoding=encoding):
+        for col in COLUMNAS_NUMERICAS:
+            if col in chunk.columns:
+                chunk[col] = pd.to_numeric(chunk[col], errors='coerce')
+        yield chunk
+
+def estimar_filas_csv(archivo, muestra_bytes=1 << 16):
+    if not hasattr(archivo, 'seek'):
+        return None
+    archivo.seek(0, os.SEEK_END)
+    tamano = archivo.tell()
+    archivo.seek(0)
+    muestra = archivo.read(muestra_bytes)
+    archivo.seek(0)
+    lineas = muestra.count(b'\n' if isinstance(muestra, bytes) else '\n')
+    if not lineas:
+        return None
+    return max(int(tamano / (len(muestra) / lineas)) - 1, 0)
+
+def leer_parquet_por_bloques(archivo, chunk_size=5000):
+    import pyarrow.parquet as pq
+    
+    # iter_batches recorre los row groups sin cargar el archivo completo
+    archivo_pq = pq.ParquetFile(archivo)
+    for batch in archivo_pq.iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+def estimar_filas_parquet(archivo):
+    import pyarrow.parquet as pq
+    
+    total = pq.ParquetFile(archivo).metadata.num_rows
+    if hasattr(archivo, 'seek'):
+        archivo.seek(0)
+    return total
+
+def listar_hojas(archivo, nombre):
+    if tipo_archivo(nombre) == 'xlsx':
+        return listar_hojas_excel(archivo)
+    return [None]
+
+def omitir_filas(bloques, saltar_filas):
+    for chunk in bloques:
+        if saltar_filas >= len(chunk):
+            saltar_filas -= len(chunk)
+            continue
+        if saltar_filas:
+            chunk = chunk.iloc[saltar_filas:].reset_index(drop=True)
+            saltar_filas = 0
+        yield chunk
+
+def leer_archivo_por_bloques(archivo, nombre, chunk_size=5000, hoja=None, saltar_filas=0):
+    tipo = tipo_archivo(nombre)
+    if tipo == 'csv':
+        return omitir_filas(leer_csv_por_bloques(archivo, chunk_size=chunk_size), saltar_filas)
+    if tipo == 'parquet':
+        return omitir_filas(leer_parquet_por_bloques(archivo, chunk_size=chunk_size), saltar_filas)
+    return leer_excel_por_bloques(archivo, chunk_size=chunk_size, hoja=hoja, saltar_filas=saltar_filas)
+
+def estimar_filas_archivo(archivo, nombre, hoja=None):
+    tipo = tipo_archivo(nombre)
+    if tipo == 'csv':
+        return estimar_filas_csv(archivo)
+    if tipo == 'parquet':
+        return estimar_filas_parquet(archivo)
+    return estimar_filas_excel(archivo, hoja=hoja)
+
+# Validación previa: solo encabezado y una muestra, sin parsear el archivo completo
+NS_XLSX = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+NS_RELACIONES = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+def hojas_xlsx(libro):
+    relaciones = {rel.get('Id'): rel.get('Target')
+                  for rel in ET.fromstring(libro.read('xl/_rels/workbook.xml.rels'))}
+    hojas = []
+    for hoja in ET.fromstring(libro.read('xl/workbook.xml')).iter(f'{NS_XLSX}sheet'):
+        destino = relaciones[hoja.get(f'{NS_RELACIONES}id')]
+        ruta = destino.lstrip('/') if destino.startswith('/') else 'xl/' + destino
+        hojas.append((hoja.get('name'), ruta))
+    return hojas
+
+def columna_celda(referencia):
+    indice = 0
+    for letra in referencia:
+        if not letra.isalpha():
+            break
+        indice = indice * 26 + ord(letra.upper()) - 64
+    return indice - 1
+
+def textos_compartidos(libro, indices):
+    # Se lee sharedStrings.xml solo hasta el mayor índice usado por la muestra
+    if not indices or 'xl/sharedStrings.xml' not in libro.namelist():
+        return {}
+    maximo = max(indices)
+    textos = {}
+    with libro.open('xl/sharedStrings.xml') as f:
+        for i, (_, elem) in enumerate(e for e in ET.iterparse(f) if e[1].tag == f'{NS_XLSX}si'):
+            if i in indices:
+                textos[i] = ''.join(t.text or '' for t in elem.iter(f'{NS_XLSX}t'))
+            elem.clear()
+            if i >= maximo:
+                break
+    return textos
+
+def leer_muestra_xlsx(archivo, hoja=None, muestra=50):
+    with zipfile.ZipFile(archivo) as libro:
+        hojas = dict(hojas_xlsx(libro))
+        ruta = hojas[hoja] if hoja else next(iter(hojas.values()))
         
-        columnas_db = ['id_carga'] + [v for v in columnas_map.values() if v in df_insert.columns]
-        df_insert = df_insert[columnas_db]
+        filas_estimadas = None
+        filas = []
+        with libro.open(ruta) as f:
+            for _, elem in ET.iterparse(f):
+                if elem.tag == f'{NS_XLSX}dimension':
+                    ultima = elem.get('ref', '').split(':')[-1]
+                    digitos = ''.join(c for c in ultima if c.isdigit())
+                    filas_estimadas = max(int(digitos) - 1, 0) if digitos else None
+                elif elem.tag == f'{NS_XLSX}row':
+                    fila = {}
+                    for celda in elem.iter(f'{NS_XLSX}c'):
+                        tipo = celda.get('t')
+                        valor = celda.find(f'{NS_XLSX}v')
+                        if tipo == 'inlineStr':
+                            fila[columna_celda(celda.get('r'))] = ''.join(t.text or '' for t in celda.iter(f'{NS_XLSX}t'))
+                        elif valor is not None and valor.text is not None:
+                            if tipo == 's':
+                                fila[columna_celda(celda.get('r'))] = ('s', int(valor.text))
+                            elif tipo in ('str', 'e'):
+                                fila[columna_celda(celda.get('r'))] = valor.text
+                            else:
+                                fila[columna_celda(celda.get('r'))] = float(valor.text)
+                    filas.append(fila)
+                    elem.clear()
+                    if len(filas) > muestra:
+                        break
         
-        chunk_size = 5000
-        total_rows = len(df_insert)
-        num_chunks = math.ceil(total_rows / chunk_size)
+        indices = {v[1] for fila in filas for v in fila.values() if isinstance(v, tuple)}
+        textos = textos_compartidos(libro, indices)
+    
+    if hasattr(archivo, 'seek'):
+        archivo.seek(0)
+    if not filas:
+        return pd.DataFrame(), 0
+    
+    filas = [{k: textos.get(v[1]) if isinstance(v, tuple) else v for k, v in fila.items()} for fila in filas]
+    ancho = max(filas[0]) + 1 if filas[0] else 0
+    columnas = [str(filas[0].get(i)) if filas[0].get(i) is not None else f"Unnamed: {i}" for i in range(ancho)]
+    datos = [[fila.get(i) for i in range(ancho)] for fila in filas[1:]]
+    return pd.DataFrame(datos, columns=columnas), filas_estimadas
+
+def leer_muestra_archivo(archivo, nombre, hoja=None, muestra=50):
+    tipo = tipo_archivo(nombre)
+    if tipo == 'csv':
+        df = pd.read_csv(archivo, sep=detectar_separador_csv(archivo), dtype=str, nrows=muestra, encoding='utf-8-sig')
+        archivo.seek(0)
+        return df, estimar_filas_csv(archivo)
+    if tipo == 'parquet':
+        import pyarrow.parquet as pq
         
-        for i in range(num_chunks):
-            start_idx = i * chunk_size
-            end_idx = start_idx + chunk_size
-            chunk = df_insert.iloc[start_idx:end_idx]
+        archivo_pq = pq.ParquetFile(archivo)
+        lote = next(archivo_pq.iter_batches(batch_size=muestra), None)
+        df = lote.to_pandas() if lote is not None else archivo_pq.schema_arrow.empty_table().to_pandas()
+        filas = archivo_pq.metadata.num_rows
+        if hasattr(archivo, 'seek'):
+            archivo.seek(0)
+        return df, filas
+    return leer_muestra_xlsx(archivo, hoja=hoja, muestra=muestra)
+
+def revisar_tipos_muestra(df):
+    problemas = []
+    if df.empty:
+        return problemas
+    # Celdas vacías o solo con espacios son datos faltantes, no valores mal tipados
+    df = df.replace(r'^\s*$', np.nan, regex=True)
+    
+    for col in COLUMNAS_NUMERICAS:
+        if col in df.columns:
+            valores = df[col].dropna()
+            invalidos = valores[pd.to_numeric(valores, errors='coerce').isna()]
+            if len(invalidos):
+                problemas.append(f"'{col}' no es numérico en {len(invalidos)} de {len(valores)} filas de muestra "
+                                 f"(ej. {invalidos.iloc[0]!r})")
+    
+    if 'Fecha' in df.columns:
+        valores = df['Fecha'].dropna()
+        # En .xlsx una fecha llega como número de serie de Excel
+        numericos = pd.to_numeric(valores, errors='coerce')
+        texto = valores[numericos.isna()].astype(str)
+        invalidos = texto[pd.to_datetime(texto, format='mixed', errors='coerce').isna()]
+        if len(invalidos):
+            problemas.append(f"'Fecha' no es una fecha en {len(invalidos)} de {len(valores)} filas de muestra "
+                             f"(ej. {invalidos.iloc[0]!r})")
+    
+    if 'CODUNICOCLI_13_enc' in df.columns and df['CODUNICOCLI_13_enc'].isna().any():
+        problemas.append(f"'CODUNICOCLI_13_enc' vacío en {int(df['CODUNICOCLI_13_enc'].isna().sum())} filas de muestra")
+    return problemas
+
+def validar_archivo(archivo, nombre, muestra=50, todas_las_hojas=False):
+    # Una entrada por unidad que se va a cargar, en fracciones de segundo: la carga de un archivo lee
+    # solo la primera hoja de un .xlsx; la paralela (todas_las_hojas), cada hoja de listar_hojas
+    inicio = time.time()
+    hojas = listar_hojas(archivo, nombre) if todas_las_hojas else [None]
+    
+    resultados = []
+    for hoja in hojas:
+        df, filas_estimadas = leer_muestra_archivo(archivo, nombre, hoja=hoja, muestra=muestra)
+        resultados.append({
+            'archivo': nombre,
+            'hoja': hoja,
+            'faltantes': [col for col in COLUMNAS_REQUERIDAS if col not in df.columns],
+            'problemas': revisar_tipos_muestra(df),
+            'filas_estimadas': filas_estimadas,
+            'segundos': time.time() - inicio
+        })
+    return resultados
+
+def cargar_bloques(bloques, codigo_carga, conn, progress_callback=None, total_estimado=None,
+                   archivo_origen=None, estadisticas=None, masivo=False, reconstruir_indices=False,
+                   modo_duplicados=None):
+    with (pragmas_carga_masiva(conn) if masivo else nullcontext()):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO cargas (codigo_carga, archivo_origen, registros_totales) VALUES (?, ?, ?)",
+                           (codigo_carga, archivo_origen, 0))
+            id_carga = cursor.lastrowid
             
-            chunk.to_sql('transacciones', conn, if_exists='append', index=False)
+            if reconstruir_indices:
+                eliminar_indices_transacciones(conn)
             
-            if progress_callback:
-                progress_callback((i + 1) / num_chunks)
+            filas_procesadas = 0
+            duplicados = 0
+            memo_glosas = {}
+            
+            for i, chunk in enumerate(bloques):
+                if i == 0:
+                    faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in chunk.columns]
+                    if faltantes:
+                        raise ValueError(f"Columnas faltantes: {', '.join(faltantes)}")
                 
-        conn.commit()
-        return id_carga
+                df_insert = preparar_transacciones(chunk, id_carga, memo_glosas=memo_glosas, estadisticas=estadisticas)
+                
+                duplicados += escribir_bloque(df_insert, conn, modo_duplicados=modo_duplicados,
+                                              estadisticas=estadisticas)
+                filas_procesadas += len(df_insert)
+                
+                if progress_callback:
+                    progreso = min(filas_procesadas / total_estimado, 1.0) if total_estimado else 0.0
+                    progress_callback(progreso, filas_procesadas)
+            
+            if reconstruir_indices:
+                crear_indices_transacciones(conn)
+            
+            actualizar_agregados_carga(conn, id_carga)
+            cursor.execute("UPDATE cargas SET registros_totales = ?, duplicados = ? WHERE id_carga = ?",
+                           (filas_procesadas, duplicados, id_carga))
+            conn.commit()
+            return id_carga
+
+        except Exception as e:
+            conn.rollback()
+            raise e
 
+def cargar_datos_streaming(archivo, codigo_carga, conn, progress_callback=None, chunk_size=5000,
+                           estadisticas=None, masivo=False, reconstruir_indices=False, nombre=None,
+                           modo_duplicados=None):
+    nombre = nombre or getattr(archivo, 'name', None)
+    total_estimado = estimar_filas_archivo(archivo, nombre)
+    return cargar_bloques(leer_archivo_por_bloques(archivo, nombre, chunk_size=chunk_size), codigo_carga, conn,
+                          progress_callback=progress_callback, total_estimado=total_estimado,
+                          archivo_origen=nombre, estadisticas=estadisticas,
+                          masivo=masivo, reconstruir_indices=reconstruir_indices,
+                          modo_duplicados=modo_duplicados)
+
+def huella_archivo(archivo, bloque=1 << 20):
+    # Tamaño y hash del primer bloque: identifica el archivo de una carga reanudable sin leerlo completo
+    posicion = archivo.tell()
+    archivo.seek(0, os.SEEK_END)
+    tamano = archivo.tell()
+    archivo.seek(0)
+    inicio = archivo.read(bloque)
+    archivo.seek(posicion)
+    return f"{tamano}:{hashlib.sha256(inicio).hexdigest()}"
+
+def obtener_carga_pendiente(conn, codigo_carga):
+    return conn.execute("""
+        SELECT id_carga, filas_confirmadas, huella_archivo FROM cargas
+        WHERE codigo_carga = ? AND estado = 'EN_PROCESO'
+    """, (codigo_carga,)).fetchone()
+
+def cargar_datos_reanudable(archivo, codigo_carga, conn, progress_callback=None, chunk_size=5000,
+                            estadisticas=None, masivo=False, nombre=None, modo_duplicados=None, turno=None):
+    # Cada bloque se confirma junto con el avance en cargas; si el proceso se interrumpe,
+    # una nueva llamada con el mismo codigo_carga continúa desde la última fila confirmada.
+    # turno (p. ej. lambda: turno_escritura(db_path)) envuelve cada transacción confirmada
+    nombre = nombre or getattr(archivo, 'name', None)
+    turno = turno or nullcontext
+    cursor = conn.cursor()
+    huella = huella_archivo(archivo)
+    
+    pendiente = obtener_carga_pendiente(conn, codigo_carga)
+    if pendiente:
+        id_carga, filas_confirmadas, huella_pendiente = pendiente
+        # Con otro archivo (o uno editado) se saltarían filas que no son las ya confirmadas
+        if huella_pendiente and huella_pendiente != huella:
+            raise ValueError(f"El archivo no coincide con el de la carga pendiente '{codigo_carga}' "
+                             f"({filas_confirmadas:,} filas confirmadas); use el mismo archivo o purgue la carga")
+    else:
+        with turno():
+            cursor.execute("""
+                INSERT INTO cargas (codigo_carga, archivo_origen, registros_totales, estado, filas_confirmadas, huella_archivo)
+                VALUES (?, ?, 0, 'EN_PROCESO', 0, ?)
+            """, (codigo_carga, nombre, huella))
+            id_carga = cursor.lastrowid
+            filas_confirmadas = 0
+            conn.commit()
+    
+    total_estimado = estimar_filas_archivo(archivo, nombre)
+    bloques = leer_archivo_por_bloques(archivo, nombre, chunk_size=chunk_size, saltar_filas=filas_confirmadas)
+    
+    with (pragmas_carga_masiva(conn, PRAGMAS_CARGA_REANUDABLE) if masivo else nullcontext()):
+        try:
+            memo_glosas = {}
+            filas_procesadas = filas_confirmadas
+            
+            for i, chunk in enumerate(bloques):
+                if i == 0:
+                    faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in chunk.columns]
+                    if faltantes:
+                        raise ValueError(f"Columnas faltantes: {', '.join(faltantes)}")
+                
+                df_insert = preparar_transacciones(chunk, id_carga, memo_glosas=memo_glosas, estadisticas=estadisticas)
+                
+                with turno():
+                    duplicados = escribir_bloque(df_insert, conn, modo_duplicados=modo_duplicados,
+                                                 estadisticas=estadisticas)
+                    cursor.execute("""
+                        UPDATE cargas SET filas_confirmadas = ?, duplicados = COALESCE(duplicados, 0) + ?
+                        WHERE id_carga = ?
+                    """, (filas_procesadas + len(df_insert), duplicados, id_carga))
+                    conn.commit()
+                filas_procesadas += len(df_insert)
+                
+                if progress_callback:
+                    progreso = min(filas_procesadas / total_estimado, 1.0) if total_estimado else 0.0
+                    progress_callback(progreso, filas_procesadas)
+            
+            # Los agregados se arman al completar; los bloques ya confirmados de una carga en curso no figuran en ellos
+            with turno():
+                actualizar_agregados_carga(conn, id_carga)
+                cursor.execute("""
+                    UPDATE cargas SET estado = 'COMPLETA', registros_totales = ?, filas_confirmadas = ?
+                    WHERE id_carga = ?
+                """, (filas_procesadas, filas_procesadas, id_carga))
+                conn.commit()
+            return id_carga
+
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+def procesar_unidad_archivo(contenido, nombre_archivo, hoja, cola, cancelado, chunk_size=5000):
+    # Se ejecuta en un proceso del pool: parsea y limpia el archivo u hoja, el escritor inserta los bloques
+    clave = (nombre_archivo, hoja)
+    estadisticas = {}
+    memo_glosas = {}
+    try:
+        bloques = leer_archivo_por_bloques(BytesIO(contenido), nombre_archivo, chunk_size=chunk_size, hoja=hoja)
+        for i, chunk in enumerate(bloques):
+            if cancelado.is_set():
+                return
+            if i == 0:
+                faltantes = [col for col in COLUMNAS_REQUERIDAS if col not in chunk.columns]
+                if faltantes:
+                    raise ValueError(f"Columnas faltantes: {', '.join(faltantes)}")
+            cola.put(('bloque', clave, preparar_transacciones(chunk, None, memo_glosas=memo_glosas,
+                                                              estadisticas=estadisticas)))
+        cola.put(('fin', clave, estadisticas))
     except Exception as e:
-        conn.rollback()
-        raise e
+        cola.put(('error', clave, str(e)))
+
+def describir_unidad(clave):
+    nombre, hoja = clave
+    return f"{nombre} [{hoja}]" if hoja else nombre
+
+def combinar_estadisticas_glosas(estadisticas, parcial):
+    if estadisticas is None or not parcial.get('filas'):
+        return
+    for campo in ('filas', 'glosas_unicas', 'segundos_limpieza'):
+        estadisticas[campo] = estadisticas.get(campo, 0) + parcial[campo]
+    estadisticas['ratio_dedup'] = estadisticas['filas'] / max(estadisticas['glosas_unicas'], 1)
+    estadisticas['filas_por_seg'] = estadisticas['filas'] / max(estadisticas['segundos_limpieza'], 1e-9)
+
+def cargar_archivos_paralelo(archivos, codigo_carga, conn, progress_callback=None, max_workers=None,
+                             chunk_size=5000, estadisticas=None, masivo=False, reconstruir_indices=False,
+                             modo_duplicados=None, turno=None):
+    # archivos: lista de (nombre, bytes). Cada archivo (u hoja de cada libro) se procesa en paralelo y
+    # esta conexión es el único escritor, todo bajo un mismo codigo_carga. Sin turno la carga es una sola
+    # transacción; con turno (procesador de cargas) cada bloque se confirma dentro de un turno del escritor,
+    # la carga queda EN_PROCESO hasta el final y, si falla, se purga
+    por_bloques = turno is not None
+    turno = turno or nullcontext
+    id_carga = None
+    unidades = []
+    totales = {}
+    for nombre, contenido in archivos:
+        for hoja in listar_hojas(BytesIO(contenido), nombre):
+            unidades.append((nombre, hoja, contenido))
+            totales[(nombre, hoja)] = estimar_filas_archivo(BytesIO(contenido), nombre, hoja=hoja)
+    
+    filas_por_unidad = {clave: 0 for clave in totales}
+    contexto = multiprocessing.get_context('spawn')
+    max_workers = max_workers or min(len(unidades), os.cpu_count() or 1)
+    
+    with contexto.Manager() as manager:
+        cola = manager.Queue(maxsize=2 * max_workers)
+        cancelado = manager.Event()
+        
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=contexto) as executor:
+            futuros = [executor.submit(procesar_unidad_archivo, contenido, nombre, hoja, cola, cancelado, chunk_size)
+                       for nombre, hoja, contenido in unidades]
+            
+            with (pragmas_carga_masiva(conn) if masivo else nullcontext()):
+                try:
+                    cursor = conn.cursor()
+                    with turno():
+                        # Restos de un trabajo cortado por un reinicio: se descartan y la carga empieza de nuevo
+                        pendiente = obtener_carga_pendiente(conn, codigo_carga) if por_bloques else None
+                        if pendiente:
+                            purgar_carga(conn, pendiente[0])
+                        cursor.execute("INSERT INTO cargas (codigo_carga, archivo_origen, registros_totales, estado) VALUES (?, ?, ?, ?)",
+                                       (codigo_carga, ', '.join(nombre for nombre, _ in archivos), 0,
+                                        'EN_PROCESO' if por_bloques else 'COMPLETA'))
+                        id_carga = cursor.lastrowid
+                        
+                        if reconstruir_indices:
+                            eliminar_indices_transacciones(conn)
+                        if por_bloques:
+                            conn.commit()
+                    
+                    pendientes = len(unidades)
+                    duplicados = 0
+                    while pendientes:
+                        try:
+                            tipo, clave, contenido = cola.get(timeout=1)
+                        except queue.Empty:
+                            for futuro in futuros:
+                                if futuro.done() and futuro.exception():
+                                    raise futuro.exception()
+                            continue
+                        
+                        if tipo == 'error':
+                            raise ValueError(f"{describir_unidad(clave)}: {contenido}")
+                        if tipo == 'fin':
+                            pendientes -= 1
+                            combinar_estadisticas_glosas(estadisticas, contenido)
+                            continue
+                        
+                        contenido['id_carga'] = id_carga
+                        with turno():
+                            duplicados += escribir_bloque(contenido, conn, modo_duplicados=modo_duplicados,
+                                                          estadisticas=estadisticas)
+                            if por_bloques:
+                                cursor.execute("UPDATE cargas SET filas_confirmadas = ? WHERE id_carga = ?",
+                                               (sum(filas_por_unidad.values()) + len(contenido), id_carga))
+                                conn.commit()
+                        filas_por_unidad[clave] += len(contenido)
+                        
+                        if progress_callback:
+                            total = totales[clave]
+                            progreso = min(filas_por_unidad[clave] / total, 1.0) if total else 0.0
+                            progress_callback(clave, progreso, filas_por_unidad[clave])
+                    
+                    with turno():
+                        if reconstruir_indices:
+                            crear_indices_transacciones(conn)
+                        
+                        actualizar_agregados_carga(conn, id_carga)
+                        filas = sum(filas_por_unidad.values())
+                        cursor.execute("""
+                            UPDATE cargas SET estado = 'COMPLETA', registros_totales = ?, filas_confirmadas = ?,
+                                   duplicados = ?
+                            WHERE id_carga = ?
+                        """, (filas, filas, duplicados, id_carga))
+                        conn.commit()
+                    return id_carga
+                
+                except Exception as e:
+                    conn.rollback()
+                    cancelado.set()
+                    for futuro in futuros:
+                        futuro.cancel()
+                    # Vaciar la cola para liberar a los procesos bloqueados en put()
+                    while not all(futuro.done() for futuro in futuros):
+                        try:
+                            cola.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+                    if por_bloques and id_carga is not None:
+                        with turno():
+                            purgar_carga(conn, id_carga)
+                            if reconstruir_indices:
+                                crear_indices_transacciones(conn)
+                                conn.commit()
+                    raise e
+
+# Resumen diario por cliente: se mantiene al cerrar cada carga y lo leen los detectores por día.
+# Solo resume filas con monto (los filtros de monto de la lectura del caso excluyen las nulas). Agrupa
+# por el texto de fecha para que los filtros de fecha se comparen igual que en la lectura del caso
+COLUMNAS_RESUMEN_DIARIO = ['id_cliente', 'fecha', 'fecha_int', 'i_e', 'grupo', 'canal', 'moneda', 'segmento',
+                           'destipdocumento', 'act_economica']
+
+def sql_resumen_diario(condicion):
+    columnas = ', '.join(COLUMNAS_RESUMEN_DIARIO)
+    return f"""
+        INSERT INTO resumen_diario (id_carga, {columnas}, operaciones, monto_total, monto_min, monto_max)
+        SELECT id_carga, {columnas}, COUNT(*), SUM(monto), MIN(monto), MAX(monto)
+        FROM transacciones
+        WHERE {condicion} AND monto IS NOT NULL AND COALESCE(duplicado, 0) = 0
+        GROUP BY id_carga, {columnas}
+    """
+
+# Cubo mensual sin cliente: totales de toda la base por mes y dimensiones de reporte
+DIMENSIONES_CUBO = ['canal', 'grupo', 'agencia', 'operador', 'act_economica', 'segmento', 'moneda', 'i_e',
+                    'tipo_marca', 'delito', 'destipdocumento']
+
+def sql_cubo_mensual(condicion):
+    columnas = ', '.join(DIMENSIONES_CUBO)
+    return f"""
+        INSERT INTO cubo_mensual (id_carga, mes, {columnas}, operaciones, monto_total)
+        SELECT id_carga, fecha_int / 100, {columnas}, COUNT(*), TOTAL(monto)
+        FROM transacciones
+        WHERE {condicion} AND COALESCE(duplicado, 0) = 0
+        GROUP BY id_carga, fecha_int / 100, {columnas}
+    """
+
+# Catálogo: totales por carga y valores distintos de cada dimensión, para no recorrer transacciones
+# en el inicio, la lista de cargas y los selectores
+COLUMNAS_CATALOGO = COLUMNAS_DIMENSION + ['destipdocumento']
+
+def sql_fecha_entero(expresion):
+    # AAAAMMDD -> 'AAAA-MM-DD' (NULL se mantiene)
+    return (f"CASE WHEN {expresion} IS NOT NULL THEN "
+            f"printf('%04d-%02d-%02d', {expresion} / 10000, {expresion} / 100 % 100, {expresion} % 100) END")
+
+def sql_estadisticas_carga(condicion):
+    # El rango sale de fecha_int, ya parseada al cargar: date(fecha) es NULL para fechas que no vienen en ISO
+    return f"""
+        INSERT INTO estadisticas_carga (id_carga, filas, filas_unicas, clientes, fecha_min, fecha_max, monto_total)
+        SELECT id_carga, filas, filas_unicas, clientes,
+               {sql_fecha_entero('fecha_int_min')}, {sql_fecha_entero('fecha_int_max')}, monto_total
+        FROM (
+            SELECT id_carga, COUNT(*) AS filas, SUM(COALESCE(duplicado, 0) = 0) AS filas_unicas,
+                   COUNT(DISTINCT id_cliente) AS clientes, MIN(fecha_int) AS fecha_int_min,
+                   MAX(fecha_int) AS fecha_int_max,
+                   TOTAL(CASE WHEN COALESCE(duplicado, 0) = 0 THEN monto END) AS monto_total
+            FROM transacciones
+            WHERE {condicion}
+            GROUP BY id_carga
+        )
+    """
+
+def sql_catalogo_valores(condicion):
+    # La CTE se materializa una vez y se recorre por cada dimensión
+    selects = ' UNION ALL '.join(
+        f"SELECT id_carga, '{col}', {col}, COUNT(*) FROM filas WHERE {col} IS NOT NULL GROUP BY id_carga, {col}"
+        for col in COLUMNAS_CATALOGO
+    )
+    return f"""
+        INSERT INTO catalogo_valores (id_carga, dimension, valor, filas)
+        WITH filas AS MATERIALIZED (SELECT id_carga, {', '.join(COLUMNAS_CATALOGO)} FROM transacciones WHERE {condicion})
+        {selects}
+    """
 
-def obtener_datos_caso(id_caso, conn, filtros=None):
+# Tablas derivadas de transacciones que se rehacen por carga
+TABLAS_AGREGADAS = {
+    'resumen_diario': sql_resumen_diario,
+    'cubo_mensual': sql_cubo_mensual,
+    'estadisticas_carga': sql_estadisticas_carga,
+    'catalogo_valores': sql_catalogo_valores
+}
+
+def actualizar_agregados_carga(conn, id_carga):
+    # Corre dentro de la transacción que cierra la carga, recorriendo solo sus filas vía idx_carga
+    for tabla, sql in TABLAS_AGREGADAS.items():
+        conn.execute(f"DELETE FROM {tabla} WHERE id_carga = ?", (id_carga,))
+        conn.execute(sql("id_carga = ?"), (id_carga,))
+
+def reconstruir_agregados(conn):
+    for tabla, sql in TABLAS_AGREGADAS.items():
+        conn.execute(f"DELETE FROM {tabla}")
+        conn.execute(sql("1 = 1"))
+
+def obtener_resumen_diario_caso(id_caso, conn, filtros=None):
+    # Devuelve None si el rango de monto corta algún grupo: esos totales no se pueden separar y el
+    # análisis debe agregar las filas del caso
     query = """
-    SELECT t.* FROM transacciones t
-    INNER JOIN caso_involucrados ci ON t.codunicocli_13_enc = ci.codunicocli_13_enc
-    WHERE ci.id_caso = ?
+        SELECT c.codunicocli_13_enc, r.fecha_int, r.i_e, r.grupo, r.canal, r.moneda, r.segmento,
+               r.destipdocumento, r.act_economica, r.operaciones, r.monto_total, r.monto_min, r.monto_max
+        FROM resumen_diario r
+        INNER JOIN caso_involucrados ci ON r.id_cliente = ci.id_cliente
+        INNER JOIN clientes c ON c.id_cliente = r.id_cliente
+        WHERE ci.id_caso = ?
+    """
+    params = [int(id_caso)]
+    codificado = dimensiones_codificadas(conn)
+    codigos = obtener_codigos_dimensiones(conn) if codificado else None
+    filtros = filtros or {}
+    
+    if filtros.get('moneda') and filtros['moneda'] != 'AMBOS':
+        query += " AND r.moneda = ?"
+        params.append(valor_almacenado(codigos, 'moneda', filtros['moneda']))
+    if filtros.get('tipo_documento') and filtros['tipo_documento'] != 'AMBOS':
+        query += " AND r.destipdocumento = ?"
+        params.append(filtros['tipo_documento'])
+    if filtros.get('ie') and filtros['ie'] != 'AMBOS':
+        query += " AND r.i_e = ?"
+        params.append(valor_almacenado(codigos, 'i_e', filtros['ie'].title()))
+    if filtros.get('fecha_min'):
+        query += " AND r.fecha >= ?"
+        params.append(filtros['fecha_min'])
+    if filtros.get('fecha_max'):
+        query += " AND r.fecha <= ?"
+        params.append(filtros['fecha_max'])
+    if isinstance(filtros.get('segmento'), list):
+        if filtros['segmento']:
+            query += f" AND r.segmento IN ({','.join(['?'] * len(filtros['segmento']))})"
+            params.extend(valor_almacenado(codigos, 'segmento', v) for v in filtros['segmento'])
+    elif filtros.get('segmento') and filtros['segmento'] != 'AMBOS':
+        query += " AND r.segmento = ?"
+        params.append(valor_almacenado(codigos, 'segmento', filtros['segmento']))
+    
+    df = pd.read_sql_query(query, conn, params=params)
+    df = recortar_resumen_monto(df, filtros.get('monto_min'), filtros.get('monto_max'))
+    if df is None:
+        return None
+    if codificado:
+        df = decodificar_dimensiones(df, conn)
+    df['fecha_dt'] = entero_a_fecha(df['fecha_int'])
+    return df.drop(columns=['fecha_int'])
+
+def recortar_resumen_monto(df, minimo=None, maximo=None, incluir_maximo=True):
+    # Conserva los grupos cuyas filas caen todas en el rango; None si alguno queda partido
+    dentro = pd.Series(True, index=df.index)
+    fuera = pd.Series(False, index=df.index)
+    if minimo is not None:
+        dentro &= df['monto_min'] >= minimo
+        fuera |= df['monto_max'] < minimo
+    if maximo is not None:
+        dentro &= (df['monto_max'] <= maximo) if incluir_maximo else (df['monto_max'] < maximo)
+        fuera |= (df['monto_min'] > maximo) if incluir_maximo else (df['monto_min'] >= maximo)
+    if not (dentro | fuera).all():
+        return None
+    return df[dentro]
+
+def obtener_totales_cubo(conn, columnas, filtros=None, dropna=True):
+    # Los filtros de fecha se aplican por mes completo; el rango de monto no se puede aplicar al cubo
+    query = f"""
+        SELECT {', '.join(columnas)}, SUM(operaciones) AS id_transaccion, SUM(monto_total) AS monto
+        FROM cubo_mensual WHERE 1 = 1
+    """
+    params = []
+    codificado = dimensiones_codificadas(conn)
+    codigos = obtener_codigos_dimensiones(conn) if codificado else None
+    filtros = filtros or {}
+    
+    if filtros.get('moneda') and filtros['moneda'] != 'AMBOS':
+        query += " AND moneda = ?"
+        params.append(valor_almacenado(codigos, 'moneda', filtros['moneda']))
+    if filtros.get('tipo_documento') and filtros['tipo_documento'] != 'AMBOS':
+        query += " AND destipdocumento = ?"
+        params.append(filtros['tipo_documento'])
+    if filtros.get('ie') and filtros['ie'] != 'AMBOS':
+        query += " AND i_e = ?"
+        params.append(valor_almacenado(codigos, 'i_e', filtros['ie'].title()))
+    if filtros.get('fecha_min'):
+        query += " AND mes >= ?"
+        params.append(int(filtros['fecha_min'][:7].replace('-', '')))
+    if filtros.get('fecha_max'):
+        query += " AND mes <= ?"
+        params.append(int(filtros['fecha_max'][:7].replace('-', '')))
+    if isinstance(filtros.get('segmento'), list):
+        if filtros['segmento']:
+            query += f" AND segmento IN ({','.join(['?'] * len(filtros['segmento']))})"
+            params.extend(valor_almacenado(codigos, 'segmento', v) for v in filtros['segmento'])
+    elif filtros.get('segmento') and filtros['segmento'] != 'AMBOS':
+        query += " AND segmento = ?"
+        params.append(valor_almacenado(codigos, 'segmento', filtros['segmento']))
+    if dropna:
+        query += ''.join(f" AND {col} IS NOT NULL" for col in columnas)
+    
+    df = pd.read_sql_query(query + f" GROUP BY {', '.join(columnas)}", conn, params=params)
+    if codificado:
+        df = decodificar_dimensiones(df, conn)
+    return df
+
+def filtro_clientes(prefijo='', atributos=None):
+    # Prefijo como rango sobre el índice único del código; cada atributo tiene índice (atributo, código)
+    condiciones, params = [], []
+    if prefijo:
+        condiciones.append("codunicocli_13_enc >= ? AND codunicocli_13_enc < ?")
+        params += [prefijo, prefijo[:-1] + chr(ord(prefijo[-1]) + 1)]
+    for col, valor in (atributos or {}).items():
+        if col in ATRIBUTOS_CLIENTE and valor:
+            condiciones.append(f"{col} = ?")
+            params.append(valor)
+    return (f"WHERE {' AND '.join(condiciones)}" if condiciones else ""), params
+
+def contar_clientes(conn, prefijo='', atributos=None):
+    where, params = filtro_clientes(prefijo, atributos)
+    return conn.execute(f"SELECT COUNT(*) FROM clientes {where}", params).fetchone()[0]
+
+def buscar_clientes(conn, prefijo='', atributos=None, limite=50, desplazamiento=0):
+    where, params = filtro_clientes(prefijo, atributos)
+    return pd.read_sql_query(f"""
+        SELECT id_cliente, codunicocli_13_enc, {', '.join(ATRIBUTOS_CLIENTE)}
+        FROM clientes {where}
+        ORDER BY codunicocli_13_enc
+        LIMIT ? OFFSET ?
+    """, conn, params=params + [int(limite), int(desplazamiento)])
+
+# Reglas de cohorte para crear casos: listas de valores por columna (IN), carga, ventana de fechas y
+# umbrales por cliente sobre monto total y cantidad de operaciones
+COLUMNAS_REGLA_COHORTE = ['act_economica', 'segmento', 'tipo_marca', 'delito']
+
+def construir_consulta_cohorte(conn, reglas):
+    # SELECT de id_cliente que cumplen las reglas, evaluado por completo en SQLite
+    codigos = obtener_codigos_dimensiones(conn) if dimensiones_codificadas(conn) else None
+    condiciones = ["t.id_cliente IS NOT NULL", "COALESCE(t.duplicado, 0) = 0"]
+    params = []
+    
+    if reglas.get('codigo_carga'):
+        condiciones.append("t.id_carga = (SELECT id_carga FROM cargas WHERE codigo_carga = ?)")
+        params.append(reglas['codigo_carga'])
+    for col in COLUMNAS_REGLA_COHORTE:
+        valores = reglas.get(col)
+        if valores:
+            condiciones.append(f"t.{col} IN ({','.join(['?'] * len(valores))})")
+            params.extend(valor_almacenado(codigos, col, v) for v in valores)
+    if reglas.get('fecha_min'):
+        condiciones.append("t.fecha >= ?")
+        params.append(reglas['fecha_min'])
+    if reglas.get('fecha_max'):
+        # Hasta incluye el día completo, venga como 'YYYY-MM-DD' o con hora
+        condiciones.append("t.fecha < date(?, '+1 day')")
+        params.append(reglas['fecha_max'])
+    
+    query = f"SELECT t.id_cliente FROM transacciones t WHERE {' AND '.join(condiciones)} GROUP BY t.id_cliente"
+    umbrales = []
+    if reglas.get('monto_total_min'):
+        umbrales.append("TOTAL(t.monto) >= ?")
+        params.append(reglas['monto_total_min'])
+    if reglas.get('operaciones_min'):
+        umbrales.append("COUNT(*) >= ?")
+        params.append(int(reglas['operaciones_min']))
+    if umbrales:
+        query += f" HAVING {' AND '.join(umbrales)}"
+    return query, params
+
+def reglas_vacias(reglas):
+    # Sin ninguna regla la cohorte sería todo el directorio de clientes
+    return not any(reglas.get(clave) for clave in
+                   ['codigo_carga', 'fecha_min', 'fecha_max', 'monto_total_min', 'operaciones_min'] + COLUMNAS_REGLA_COHORTE)
+
+def contar_cohorte(conn, reglas):
+    query, params = construir_consulta_cohorte(conn, reglas)
+    return conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+
+def insertar_involucrados_por_reglas(conn, id_caso, reglas):
+    # Un solo INSERT ... SELECT; la confirmación queda a cargo de quien llama
+    if reglas_vacias(reglas):
+        raise ValueError("Defina al menos una regla: carga, atributos, fechas o umbrales")
+    query, params = construir_consulta_cohorte(conn, reglas)
+    cursor = conn.execute(f"""
+        INSERT INTO caso_involucrados (id_caso, codunicocli_13_enc, id_cliente)
+        SELECT DISTINCT ?, c.codunicocli_13_enc, c.id_cliente
+        FROM clientes c
+        WHERE c.id_cliente IN ({query})
+    """, [int(id_caso)] + params)
+    return cursor.rowcount
+
+def obtener_listado_casos(conn):
+    # Una sola consulta agregada sobre el directorio de clientes, sin tocar transacciones
+    return pd.read_sql_query("""
+        SELECT c.id_caso, c.nombre_caso, c.descripcion, c.fecha_creacion,
+               COUNT(ci.codunicocli_13_enc) AS num_involucrados,
+               SUM(cl.destipdocumento = 'DNI') AS num_dni,
+               SUM(cl.destipdocumento = 'RUC') AS num_ruc
+        FROM casos c
+        LEFT JOIN caso_involucrados ci ON c.id_caso = ci.id_caso
+        LEFT JOIN clientes cl ON cl.id_cliente = ci.id_cliente
+        GROUP BY c.id_caso
+        ORDER BY c.fecha_creacion DESC
+    """, conn)
+
+def obtener_involucrados_caso(conn, id_caso, limite=50, desplazamiento=0):
+    return pd.read_sql_query(f"""
+        SELECT ci.codunicocli_13_enc, {', '.join('cl.' + col for col in ATRIBUTOS_CLIENTE)}
+        FROM caso_involucrados ci
+        LEFT JOIN clientes cl ON cl.id_cliente = ci.id_cliente
+        WHERE ci.id_caso = ?
+        ORDER BY ci.codunicocli_13_enc
+        LIMIT ? OFFSET ?
+    """, conn, params=[int(id_caso), int(limite), int(desplazamiento)])
+
+def obtener_estadisticas_generales(conn):
+    # Cargas en curso o en borrado aún no figuran en estadisticas_carga
+    fila = conn.execute("""
+        SELECT COALESCE(SUM(filas), 0), COALESCE(SUM(filas_unicas), 0), MIN(fecha_min), MAX(fecha_max),
+               COALESCE(SUM(monto_total), 0)
+        FROM estadisticas_carga
+    """).fetchone()
+    return dict(zip(['filas', 'filas_unicas', 'fecha_min', 'fecha_max', 'monto_total'], fila))
+
+def obtener_valores_catalogo(conn, dimension):
+    valores = [fila[0] for fila in conn.execute(
+        "SELECT DISTINCT valor FROM catalogo_valores WHERE dimension = ?", (dimension,))]
+    if dimensiones_codificadas(conn) and dimension in COLUMNAS_DIMENSION:
+        etiquetas = obtener_dimensiones(conn)[dimension]
+        valores = [etiquetas[int(v)] for v in valores if 0 <= int(v) < len(etiquetas)]
+    return sorted(str(v) for v in valores if v != '')
+
+# Perfil del caso: valores de cada filtro, rangos de monto y fecha y conteos por moneda e I/E. Se arma
+# desde resumen_diario (mismas filas que ve el análisis con monto) y se guarda con las versiones de datos
+DIMENSIONES_PERFIL = ['moneda', 'i_e', 'segmento', 'destipdocumento']
+
+def calcular_perfil_caso(conn, id_caso):
+    df = pd.read_sql_query(f"""
+        SELECT {', '.join('r.' + col for col in DIMENSIONES_PERFIL)}, SUM(r.operaciones) AS filas,
+               MIN(r.monto_min) AS monto_min, MAX(r.monto_max) AS monto_max,
+               MIN(r.fecha_int) AS fecha_min, MAX(r.fecha_int) AS fecha_max
+        FROM resumen_diario r
+        INNER JOIN caso_involucrados ci ON r.id_cliente = ci.id_cliente
+        WHERE ci.id_caso = ?
+        GROUP BY {', '.join('r.' + col for col in DIMENSIONES_PERFIL)}
+    """, conn, params=[int(id_caso)])
+    if dimensiones_codificadas(conn):
+        df = decodificar_dimensiones(df, conn)
+
+    def fecha_texto(valor):
+        return None if pd.isna(valor) else f"{int(valor) // 10000:04d}-{int(valor) // 100 % 100:02d}-{int(valor) % 100:02d}"
+
+    def conteos(col):
+        return {str(k): int(v) for k, v in df.groupby(col, observed=True)['filas'].sum().items() if k != ''}
+
+    return {
+        'filas': int(df['filas'].sum()),
+        'valores': {col: sorted(str(v) for v in df[col].dropna().unique() if v != '') for col in DIMENSIONES_PERFIL},
+        'monto_min': None if df.empty else float(df['monto_min'].min()),
+        'monto_max': None if df.empty else float(df['monto_max'].max()),
+        'fecha_min': fecha_texto(df['fecha_min'].min()),
+        'fecha_max': fecha_texto(df['fecha_max'].max()),
+        'filas_por_moneda': conteos('moneda'),
+        'filas_por_ie': conteos('i_e')
+    }
+
+def leer_perfil_caso(conn, id_caso):
+    # None si no hay perfil o si una carga o un cambio de involucrados lo dejó atrás
+    fila = conn.execute("SELECT version_datos, version_caso, perfil FROM perfil_casos WHERE id_caso = ?",
+                        (int(id_caso),)).fetchone()
+    if fila is None or tuple(fila[:2]) != obtener_version_datos(conn, id_caso):
+        return None
+    return json.loads(fila[2])
+
+def guardar_perfil_caso(conn, id_caso, versiones, perfil):
+    conn.execute("""
+        INSERT INTO perfil_casos (id_caso, version_datos, version_caso, perfil) VALUES (?, ?, ?, ?)
+        ON CONFLICT(id_caso) DO UPDATE SET version_datos = excluded.version_datos,
+            version_caso = excluded.version_caso, perfil = excluded.perfil, fecha_calculo = CURRENT_TIMESTAMP
+    """, (int(id_caso), *versiones, json.dumps(perfil)))
+
+def obtener_perfil_caso(conn, db_path, id_caso):
+    # Se calcula con la conexión de lectura y se guarda solo si el escritor está libre: durante una carga
+    # la página no espera el lock y el perfil se guarda en una lectura posterior. Las versiones se leen
+    # antes que los datos; si una carga entra en medio, el perfil queda con la versión anterior y se rehace
+    perfil = leer_perfil_caso(conn, id_caso)
+    if perfil is not None:
+        return perfil
+    versiones = obtener_version_datos(conn, id_caso)
+    perfil = calcular_perfil_caso(conn, id_caso)
+    escritor = conexion_escritura(db_path, esperar=False)
+    if escritor is not None:
+        try:
+            guardar_perfil_caso(escritor, id_caso, versiones, perfil)
+            escritor.commit()
+        finally:
+            escritor.close()
+    return perfil
+
+def totales_por(df, columnas, conn=None, filtros=None, dropna=True):
+    # Monto y cantidad de operaciones por columnas, desde las filas del caso o, si df es None, desde el
+    # cubo de toda la base. El conteo conserva el nombre id_transaccion que muestran los reportes
+    if df is None:
+        return obtener_totales_cubo(conn, columnas, filtros, dropna=dropna)
+    return df.groupby(columnas, dropna=dropna).agg({'id_transaccion': 'count', 'monto': 'sum'}).reset_index()
+
+# Cola de cargas en segundo plano: los archivos se guardan en disco y un hilo del servidor
+# los procesa uno tras otro, dejando estado, filas y velocidad en trabajos_carga
+def directorio_trabajos(db_path):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'cargas_pendientes')
+
+def encolar_carga(conn, db_path, codigo_carga, archivos, opciones=None):
+    # archivos: lista de (nombre, bytes)
+    pendiente = conn.execute("""
+        SELECT 1 FROM trabajos_carga WHERE codigo_carga = ? AND estado IN ('PENDIENTE', 'EN_CURSO')
+    """, (codigo_carga,)).fetchone()
+    if pendiente:
+        raise ValueError("Ya hay un trabajo en cola para este código de carga.")
+    
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO trabajos_carga (codigo_carga, archivos, opciones, estado) VALUES (?, '[]', ?, 'NUEVO')",
+                   (codigo_carga, json.dumps(opciones or {})))
+    id_trabajo = cursor.lastrowid
+    
+    directorio = directorio_trabajos(db_path)
+    os.makedirs(directorio, exist_ok=True)
+    rutas = []
+    for i, (nombre, contenido) in enumerate(archivos):
+        ruta = os.path.join(directorio, f"{id_trabajo}_{i}_{os.path.basename(nombre)}")
+        with open(ruta, 'wb') as f:
+            f.write(contenido)
+        rutas.append([nombre, ruta])
+    
+    cursor.execute("UPDATE trabajos_carga SET archivos = ?, estado = 'PENDIENTE' WHERE id_trabajo = ?",
+                   (json.dumps(rutas), id_trabajo))
+    conn.commit()
+    return id_trabajo
+
+def tomar_siguiente_trabajo(conn):
+    fila = conn.execute("""
+        SELECT id_trabajo, codigo_carga, archivos, opciones FROM trabajos_carga
+        WHERE estado = 'PENDIENTE' ORDER BY id_trabajo LIMIT 1
+    """).fetchone()
+    if not fila:
+        return None
+    
+    cursor = conn.execute("""
+        UPDATE trabajos_carga SET estado = 'EN_CURSO', fecha_inicio = CURRENT_TIMESTAMP, mensaje = NULL
+        WHERE id_trabajo = ? AND estado = 'PENDIENTE'
+    """, (fila[0],))
+    conn.commit()
+    if cursor.rowcount == 0:
+        return None
+    return {'id_trabajo': fila[0], 'codigo_carga': fila[1],
+            'archivos': json.loads(fila[2]), 'opciones': json.loads(fila[3] or '{}')}
+
+def actualizar_trabajo(conn, id_trabajo, inicio, progreso, filas):
+    conn.execute("""
+        UPDATE trabajos_carga SET progreso = ?, filas_procesadas = ?, filas_por_seg = ?
+        WHERE id_trabajo = ?
+    """, (progreso, filas, filas / max(time.time() - inicio, 1e-9), id_trabajo))
+
+def ejecutar_trabajo(conn, trabajo, turno=nullcontext):
+    id_trabajo = trabajo['id_trabajo']
+    opciones = trabajo['opciones']
+    archivos = trabajo['archivos']
+    inicio = time.time()
+    estadisticas = {}
+    
+    try:
+        if len(archivos) == 1:
+            nombre, ruta = archivos[0]
+            
+            def avance(progreso, filas):
+                # La carga reanudable ya confirmó el bloque; el avance se confirma aparte
+                with turno():
+                    actualizar_trabajo(conn, id_trabajo, inicio, progreso, filas)
+                    conn.commit()
+            
+            with open(ruta, 'rb') as archivo:
+                id_carga = cargar_datos_reanudable(archivo, trabajo['codigo_carga'], conn, progress_callback=avance,
+                                                   estadisticas=estadisticas, masivo=opciones.get('masivo', False),
+                                                   nombre=nombre, modo_duplicados=opciones.get('modo_duplicados'),
+                                                   turno=turno)
+        else:
+            filas_por_unidad = {}
+            
+            def avance(clave, progreso, filas):
+                filas_por_unidad[clave] = filas
+                with turno():
+                    actualizar_trabajo(conn, id_trabajo, inicio, progreso, sum(filas_por_unidad.values()))
+                    conn.commit()
+            
+            contenidos = []
+            for nombre, ruta in archivos:
+                with open(ruta, 'rb') as f:
+                    contenidos.append((nombre, f.read()))
+            id_carga = cargar_archivos_paralelo(contenidos, trabajo['codigo_carga'], conn, progress_callback=avance,
+                                                estadisticas=estadisticas, masivo=opciones.get('masivo', False),
+                                                reconstruir_indices=opciones.get('reconstruir_indices', False),
+                                                modo_duplicados=opciones.get('modo_duplicados'), turno=turno)
+        
+        filas = conn.execute("SELECT registros_totales FROM cargas WHERE id_carga = ?", (id_carga,)).fetchone()[0]
+        with turno():
+            conn.execute("""
+                UPDATE trabajos_carga SET estado = 'COMPLETADO', progreso = 1.0, filas_procesadas = ?, filas_por_seg = ?,
+                       id_carga = ?, mensaje = ?, fecha_fin = CURRENT_TIMESTAMP
+                WHERE id_trabajo = ?
+            """, (filas, filas / max(time.time() - inicio, 1e-9), id_carga,
+                  f"{estadisticas.get('duplicados', 0):,} duplicados", id_trabajo))
+            conn.commit()
+        
+        for _, ruta in archivos:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+    except Exception as e:
+        conn.rollback()
+        with turno():
+            conn.execute("""
+                UPDATE trabajos_carga SET estado = 'ERROR', mensaje = ?, fecha_fin = CURRENT_TIMESTAMP
+                WHERE id_trabajo = ?
+            """, (str(e), id_trabajo))
+            conn.commit()
+
+def procesar_cola_cargas(db_path, intervalo=2.0):
+    # Conexión propia del procesador, pero cada transacción se confirma dentro de un turno del escritor
+    # compartido: las escrituras de la aplicación esperan a lo sumo un bloque y nunca compiten con la carga
+    conn = abrir_conexion(db_path, PRAGMAS_ESCRITURA)
+    turno = lambda: turno_escritura(db_path)
+    with turno():
+        # Un trabajo EN_CURSO al arrancar quedó cortado por un reinicio: la carga reanudable lo continúa
+        conn.execute("UPDATE trabajos_carga SET estado = 'PENDIENTE' WHERE estado = 'EN_CURSO'")
+        conn.commit()
+    
+    while True:
+        with turno():
+            trabajo = tomar_siguiente_trabajo(conn)
+        if trabajo is None:
+            time.sleep(intervalo)
+        else:
+            ejecutar_trabajo(conn, trabajo, turno)
+
+procesador_cargas = None
+bloqueo_procesador = threading.Lock()
+
+def iniciar_procesador_cargas(db_path):
+    # Un único hilo por proceso del servidor, compartido por todas las sesiones
+    global procesador_cargas
+    with bloqueo_procesador:
+        if procesador_cargas is None or not procesador_cargas.is_alive():
+            procesador_cargas = threading.Thread(target=procesar_cola_cargas, args=(db_path,),
+                                                 name='procesador_cargas', daemon=True)
+            procesador_cargas.start()
+    return procesador_cargas
+
+def reintentar_trabajo(conn, id_trabajo):
+    conn.execute("""
+        UPDATE trabajos_carga SET estado = 'PENDIENTE', mensaje = NULL, fecha_fin = NULL
+        WHERE id_trabajo = ? AND estado = 'ERROR'
+    """, (id_trabajo,))
+    conn.commit()
+
+def obtener_trabajos_carga(conn, limite=20):
+    return pd.read_sql_query("""
+        SELECT id_trabajo, codigo_carga, estado, ROUND(progreso * 100, 1) AS porcentaje, filas_procesadas,
+               ROUND(filas_por_seg) AS filas_por_seg, mensaje, fecha_creacion, fecha_inicio, fecha_fin
+        FROM trabajos_carga
+        ORDER BY id_trabajo DESC
+        LIMIT ?
+    """, conn, params=[limite])
+
+def reactivar_duplicados(conn, id_carga):
+    # Filas marcadas como duplicado (modo 'marcar') cuyo original está en la carga a purgar: por cada
+    # hash sin otro original fuera de ella se desmarca una copia. Devuelve las cargas afectadas
+    conn.execute("DROP TABLE IF EXISTS temp.reactivadas")
+    conn.execute("""
+        CREATE TEMP TABLE reactivadas AS
+        SELECT MIN(t.id_transaccion) AS id_transaccion FROM transacciones t
+        WHERE t.id_carga <> ? AND t.duplicado = 1
+          AND t.hash_natural IN (
+              SELECT hash_natural FROM transacciones WHERE id_carga = ? AND COALESCE(duplicado, 0) = 0
+          )
+          AND NOT EXISTS (
+              SELECT 1 FROM transacciones o
+              WHERE o.hash_natural = t.hash_natural AND o.id_carga <> ? AND COALESCE(o.duplicado, 0) = 0
+          )
+        GROUP BY t.hash_natural
+    """, (id_carga, id_carga, id_carga))
+    por_carga = conn.execute("""
+        SELECT id_carga, COUNT(*) FROM transacciones
+        WHERE id_transaccion IN (SELECT id_transaccion FROM temp.reactivadas)
+        GROUP BY id_carga
+    """).fetchall()
+    conn.execute("UPDATE transacciones SET duplicado = 0 WHERE id_transaccion IN (SELECT id_transaccion FROM temp.reactivadas)")
+    for otra, reactivadas in por_carga:
+        conn.execute("UPDATE cargas SET duplicados = MAX(COALESCE(duplicados, 0) - ?, 0) WHERE id_carga = ?",
+                     (reactivadas, otra))
+    conn.execute("DROP TABLE temp.reactivadas")
+    return [otra for otra, _ in por_carga]
+
+# Purga de cargas: borrado por lotes vía idx_carga, confirmando entre lotes para no bloquear a los lectores
+def purgar_carga(conn, id_carga, lote=50000, progress_callback=None):
+    cursor = conn.cursor()
+    total = cursor.execute("SELECT COUNT(*) FROM transacciones WHERE id_carga = ?", (id_carga,)).fetchone()[0]
+    cursor.execute("UPDATE cargas SET estado = 'ELIMINANDO' WHERE id_carga = ?", (id_carga,))
+    for tabla in TABLAS_AGREGADAS:
+        cursor.execute(f"DELETE FROM {tabla} WHERE id_carga = ?", (id_carga,))
+    # Las copias desmarcadas pasan a contar en los agregados de su carga (las cargas en curso los arman al cerrar)
+    for otra in reactivar_duplicados(conn, id_carga):
+        if cursor.execute("SELECT COALESCE(estado, 'COMPLETA') FROM cargas WHERE id_carga = ?", (otra,)).fetchone()[0] == 'COMPLETA':
+            actualizar_agregados_carga(conn, otra)
+    conn.commit()
+    
+    eliminadas = 0
+    while True:
+        cursor.execute("""
+            DELETE FROM transacciones WHERE id_transaccion IN (
+                SELECT id_transaccion FROM transacciones WHERE id_carga = ? LIMIT ?
+            )
+        """, (id_carga, lote))
+        if cursor.rowcount > 0:
+            incrementar_version_datos(conn)
+        conn.commit()
+        if cursor.rowcount <= 0:
+            break
+        eliminadas += cursor.rowcount
+        if progress_callback:
+            progress_callback(min(eliminadas / total, 1.0) if total else 1.0, eliminadas)
+    
+    cursor.execute("DELETE FROM cargas WHERE id_carga = ?", (id_carga,))
+    conn.commit()
+    return eliminadas
+
+def limpiar_huerfanos(conn):
+    # Restos de borrados hechos sin PRAGMA foreign_keys y clientes sin transacciones ni casos
+    eliminados = {}
+    consultas = {
+        'caso_involucrados': "DELETE FROM caso_involucrados WHERE id_caso NOT IN (SELECT id_caso FROM casos)",
+        'reportes_generados': "DELETE FROM reportes_generados WHERE id_caso NOT IN (SELECT id_caso FROM casos)",
+        'resumen_diario': "DELETE FROM resumen_diario WHERE id_carga NOT IN (SELECT id_carga FROM cargas)",
+        'cubo_mensual': "DELETE FROM cubo_mensual WHERE id_carga NOT IN (SELECT id_carga FROM cargas)",
+        'estadisticas_carga': "DELETE FROM estadisticas_carga WHERE id_carga NOT IN (SELECT id_carga FROM cargas)",
+        'catalogo_valores': "DELETE FROM catalogo_valores WHERE id_carga NOT IN (SELECT id_carga FROM cargas)",
+        'transacciones': """
+            DELETE FROM transacciones WHERE id_carga IN (
+                SELECT DISTINCT id_carga FROM transacciones EXCEPT SELECT id_carga FROM cargas
+            )
+        """,
+        'clientes': """
+            DELETE FROM clientes
+            WHERE NOT EXISTS (SELECT 1 FROM transacciones t WHERE t.id_cliente = clientes.id_cliente)
+              AND NOT EXISTS (SELECT 1 FROM caso_involucrados ci WHERE ci.id_cliente = clientes.id_cliente)
+        """
+    }
+    for tabla, sql in consultas.items():
+        eliminados[tabla] = conn.execute(sql).rowcount
+        conn.commit()
+    return eliminados
+
+def vacuum_incremental_habilitado(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def habilitar_vacuum_incremental(conn):
+    # Cambiar auto_vacuum en una base existente exige un VACUUM completo, una sola vez
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def recuperar_espacio(conn, paginas_por_paso=2000, progress_callback=None):
+    # Devuelve al sistema las páginas libres en pasos cortos; sin auto_vacuum incremental no hace nada
+    if not vacuum_incremental_habilitado(conn):
+        return 0
+    libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    recuperadas = 0
+    while recuperadas < libres:
+        conn.execute(f"PRAGMA incremental_vacuum({int(paginas_por_paso)})").fetchall()
+        conn.commit()
+        restantes = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if restantes >= libres - recuperadas:
+            break
+        recuperadas = libres - restantes
+        if progress_callback:
+            progress_callback(recuperadas / libres, recuperadas)
+    return recuperadas * conn.execute("PRAGMA page_size").fetchone()[0]
+
+# Columnas que usa cada análisis; None = todas (el análisis exporta el detalle completo de transacciones)
+COLUMNAS_ANALISIS = {
+    "Top 10 General": ['id_transaccion', 'canal', 'act_economica', 'agencia', 'grupo', 'operador', 'segmento',
+                       'moneda', 'monto'],
+    "1. Detección de Falsos Transportistas": None,
+    "2. Segmento Bancario vs Volumen": None,
+    "3. Actividad Económica vs Efectivo": ['id_transaccion', 'act_economica', 'grupo', 'i_e', 'monto'],
+    "4. Concentración de Efectivo por Agencia": ['id_transaccion', 'grupo', 'agencia', 'monto'],
+    "5. Pitufeo Digital (Yape/Plin)": ['id_transaccion', 'codunicocli_13_enc', 'grupo', 'monto', 'fecha_dt'],
+    "6. Retiros Hormiga en Cajeros": ['id_transaccion', 'codunicocli_13_enc', 'canal', 'i_e', 'agencia', 'grupo',
+                                      'operador', 'monto', 'fecha_dt', 'hora_num'],
+    "7. Preferencia por Operador": ['id_transaccion', 'codunicocli_13_enc', 'canal', 'operador', 'monto'],
+    "8. Red de Proveedores Comunes": ['codunicocli_13_enc', 'i_e', 'glosa_limpia', 'monto'],
+    "9. Cuentas Descartables": ['codunicocli_13_enc', 'ctacomercial', 'fecapertura', 'feccierre', 'fecha', 'glosa',
+                                'monto'],
+    "10. Velocidad del Dinero": ['codunicocli_13_enc', 'i_e', 'monto', 'fecha_dt'],
+    "11. Comportamiento por Marca": ['id_transaccion', 'tipo_marca', 'grupo', 'monto'],
+    "12. Divisa por Delito": ['id_transaccion', 'delito', 'moneda', 'monto'],
+    "13. Cuentas Puente": ['codunicocli_13_enc', 'act_economica', 'grupo', 'i_e', 'monto', 'fecha_dt'],
+    "14. Matriz Colusión Cliente-Operador": ['id_transaccion', 'codunicocli_13_enc', 'grupo', 'operador', 'monto'],
+    "15. Explosión de Pitufeo": ['codunicocli_13_enc', 'canal', 'glosa', 'monto', 'fecha_hora'],
+    "16. Minería de Texto en Glosas": ['codunicocli_13_enc', 'i_e', 'glosa_limpia', 'monto']
+}
+
+# Análisis que leen resumen_diario; True si además no necesitan las filas del caso cuando el resumen sirve
+ANALISIS_RESUMEN_DIARIO = {
+    "5. Pitufeo Digital (Yape/Plin)": False,
+    "10. Velocidad del Dinero": True,
+    "13. Cuentas Puente": True
+}
+
+# Reportes que pueden responderse con el cubo mensual sobre toda la base
+ANALISIS_CUBO = ["Top 10 General", "4. Concentración de Efectivo por Agencia", "11. Comportamiento por Marca",
+                 "12. Divisa por Delito"]
+
+def columnas_select(columnas):
+    if columnas is None:
+        return "t.*"
+    fisicas = list(dict.fromkeys(COLUMNAS_DERIVADAS.get(col, col) for col in columnas))
+    return ', '.join(f"t.{col}" for col in fisicas)
+
+def construir_consulta_caso(id_caso, conn, filtros=None, columnas=None):
+    query = f"""
+    SELECT {columnas_select(columnas)} FROM transacciones t
+    INNER JOIN caso_involucrados ci ON t.id_cliente = ci.id_cliente
+    WHERE ci.id_caso = ? AND COALESCE(t.duplicado, 0) = 0
     """
     
     params = [int(id_caso)]
+    codificado = dimensiones_codificadas(conn)
+    codigos = obtener_codigos_dimensiones(conn) if codificado else None
     
     if filtros:
         if filtros.get('moneda') and filtros['moneda'] != 'AMBOS':
             query += " AND t.moneda = ?"
-            params.append(filtros['moneda'])
+            params.append(valor_almacenado(codigos, 'moneda', filtros['moneda']))
         
         if filtros.get('tipo_documento') and filtros['tipo_documento'] != 'AMBOS':
             query += " AND t.destipdocumento = ?"
@@ -114,7 +1877,7 @@ def obtener_datos_caso(id_caso, conn, filtros=None):
             # Map UPPERCASE UI selection to Title Case DB values
             val = filtros['ie'].title() 
             query += " AND t.i_e = ?"
-            params.append(val)
+            params.append(valor_almacenado(codigos, 'i_e', val))
         
         if filtros.get('monto_min') is not None:
             query += " AND t.monto >= ?"
@@ -138,27 +1901,185 @@ def obtener_datos_caso(id_caso, conn, filtros=None):
                 if filtros['segmento']:
                     placeholders = ','.join(['?'] * len(filtros['segmento']))
                     query += f" AND t.segmento IN ({placeholders})"
-                    params.extend(filtros['segmento'])
+                    params.extend(valor_almacenado(codigos, 'segmento', v) for v in filtros['segmento'])
             elif filtros['segmento'] != 'AMBOS':
                 query += " AND t.segmento = ?"
-                params.append(filtros['segmento']) 
+                params.append(valor_almacenado(codigos, 'segmento', filtros['segmento'])) 
 
+    return query, params, codificado
+
+def obtener_datos_caso(id_caso, conn, filtros=None, columnas=None):
+    query, params, codificado = construir_consulta_caso(id_caso, conn, filtros, columnas)
     df = pd.read_sql_query(query, conn, params=params) 
-    return df
+    if codificado:
+        df = decodificar_dimensiones(df, conn)
+    return agregar_columnas_tiempo(df)
+
+# Caché de lecturas de casos compartida por todas las sesiones del servidor (LRU acotada por memoria).
+# La clave incluye las versiones de datos guardadas en la base: una carga nueva o un cambio en
+# caso_involucrados las incrementa (triggers en schema.sql) y las entradas anteriores dejan de usarse
+LIMITE_CACHE_CASOS_BYTES = 1 << 30
+
+cache_casos = OrderedDict()
+bloqueo_cache_casos = threading.Lock()
+
+def incrementar_version_datos(conn, ambito='transacciones'):
+    conn.execute("""
+        INSERT INTO versiones_datos (ambito, version) VALUES (?, 1)
+        ON CONFLICT(ambito) DO UPDATE SET version = version + 1
+    """, (ambito,))
+
+def obtener_version_datos(conn, id_caso):
+    versiones = dict(conn.execute("SELECT ambito, version FROM versiones_datos WHERE ambito IN ('transacciones', ?)",
+                                  (f"caso:{int(id_caso)}",)))
+    return versiones.get('transacciones', 0), versiones.get(f"caso:{int(id_caso)}", 0)
+
+def normalizar_filtros(filtros):
+    normalizados = {}
+    for clave, valor in (filtros or {}).items():
+        if valor is None or valor == 'AMBOS':
+            continue
+        if isinstance(valor, (list, tuple, set)):
+            valor = sorted(str(v) for v in valor)
+        normalizados[clave] = valor
+    return json.dumps(normalizados, sort_keys=True, default=str)
+
+def guardar_en_cache_casos(clave, entrada):
+    with bloqueo_cache_casos:
+        # Las entradas del caso con otra versión ya no se pueden servir
+        for obsoleta in [k for k, e in cache_casos.items() if k[0] == clave[0] and e['version'] != entrada['version']]:
+            del cache_casos[obsoleta]
+        cache_casos.pop(clave, None)
+        if entrada['tamano'] <= LIMITE_CACHE_CASOS_BYTES:
+            cache_casos[clave] = entrada
+            total = sum(e['tamano'] for e in cache_casos.values())
+            while total > LIMITE_CACHE_CASOS_BYTES:
+                _, liberada = cache_casos.popitem(last=False)
+                total -= liberada['tamano']
+
+def obtener_entrada_cache_caso(id_caso, conn, filtros=None, columnas=None, indexar=False):
+    version = obtener_version_datos(conn, id_caso)
+    clave = (int(id_caso), normalizar_filtros(filtros), tuple(columnas) if columnas is not None else None)
+    
+    with bloqueo_cache_casos:
+        entrada = cache_casos.get(clave)
+        if entrada and entrada['version'] == version:
+            cache_casos.move_to_end(clave)
+        else:
+            entrada = None
+    
+    if entrada is None:
+        df = obtener_datos_caso(id_caso, conn, filtros, columnas)
+        entrada = {'version': version, 'df': df, 'indice': None, 'tamano': int(df.memory_usage(deep=True).sum())}
+        guardar_en_cache_casos(clave, entrada)
+    
+    if indexar and entrada['indice'] is None:
+        indice = construir_indice_filtros(entrada['df'])
+        entrada['indice'] = indice
+        entrada['tamano'] += indice['tamano']
+        guardar_en_cache_casos(clave, entrada)
+    return entrada
+
+# Motor de filtros en memoria: el caso se lee una vez sin filtros y cada combinación de la barra
+# lateral se resuelve con máscaras booleanas precalculadas (categorías) y arreglos ordenados (monto, fecha)
+COLUMNAS_FILTRO = ['moneda', 'destipdocumento', 'i_e', 'segmento', 'monto', 'fecha']
+COLUMNAS_FILTRO_CATEGORICAS = ['moneda', 'destipdocumento', 'i_e', 'segmento']
+
+def construir_indice_filtros(df):
+    indice = {'mascaras': {}, 'tamano': 0}
+    for col in COLUMNAS_FILTRO_CATEGORICAS:
+        categorias = pd.Categorical(df[col].astype(object).where(df[col].notna(), None))
+        codigos = categorias.codes
+        indice['mascaras'][col] = {valor: codigos == i for i, valor in enumerate(categorias.categories)}
+        indice['tamano'] += len(categorias.categories) * len(df)
+    
+    # monto: posiciones ordenadas por valor (NaN al final, como NULL en SQL nunca cumple el rango)
+    montos = pd.to_numeric(df['monto'], errors='coerce').to_numpy(dtype=float)
+    indice['orden_monto'] = np.argsort(montos, kind='stable')
+    indice['montos_ordenados'] = montos[indice['orden_monto']]
+    
+    # fecha: códigos de las fechas distintas en orden lexicográfico, igual que la comparación de TEXT en SQLite
+    fechas = pd.Categorical(df['fecha'].astype(object).where(df['fecha'].notna(), None).map(
+        lambda v: v if v is None else str(v)))
+    indice['fechas_distintas'] = np.asarray(fechas.categories, dtype=object)
+    indice['codigos_fecha'] = fechas.codes
+    
+    indice['tamano'] += (indice['orden_monto'].nbytes + indice['montos_ordenados'].nbytes +
+                         indice['codigos_fecha'].nbytes)
+    return indice
+
+def mascara_igual(indice, col, valores, n):
+    mascara = np.zeros(n, dtype=bool)
+    for valor in valores:
+        if valor in indice['mascaras'][col]:
+            mascara |= indice['mascaras'][col][valor]
+    return mascara
+
+def mascara_filtros(indice, filtros, n):
+    mascara = np.ones(n, dtype=bool)
+    if not filtros:
+        return mascara
+    
+    if filtros.get('moneda') and filtros['moneda'] != 'AMBOS':
+        mascara &= mascara_igual(indice, 'moneda', [filtros['moneda']], n)
+    if filtros.get('tipo_documento') and filtros['tipo_documento'] != 'AMBOS':
+        mascara &= mascara_igual(indice, 'destipdocumento', [filtros['tipo_documento']], n)
+    if filtros.get('ie') and filtros['ie'] != 'AMBOS':
+        mascara &= mascara_igual(indice, 'i_e', [filtros['ie'].title()], n)
+    
+    if filtros.get('segmento'):
+        if isinstance(filtros['segmento'], list):
+            mascara &= mascara_igual(indice, 'segmento', filtros['segmento'], n)
+        elif filtros['segmento'] != 'AMBOS':
+            mascara &= mascara_igual(indice, 'segmento', [filtros['segmento']], n)
+    
+    if filtros.get('monto_min') is not None or filtros.get('monto_max') is not None:
+        ordenados = indice['montos_ordenados']
+        validos = np.count_nonzero(~np.isnan(ordenados))
+        desde = np.searchsorted(ordenados[:validos], filtros['monto_min'], 'left') if filtros.get('monto_min') is not None else 0
+        hasta = np.searchsorted(ordenados[:validos], filtros['monto_max'], 'right') if filtros.get('monto_max') is not None else validos
+        en_rango = np.zeros(n, dtype=bool)
+        en_rango[indice['orden_monto'][desde:hasta]] = True
+        mascara &= en_rango
+    
+    if filtros.get('fecha_min') or filtros.get('fecha_max'):
+        distintas = indice['fechas_distintas']
+        codigos = indice['codigos_fecha']
+        desde = np.searchsorted(distintas, filtros['fecha_min'], 'left') if filtros.get('fecha_min') else 0
+        hasta = np.searchsorted(distintas, filtros['fecha_max'], 'right') if filtros.get('fecha_max') else len(distintas)
+        mascara &= (codigos >= desde) & (codigos < hasta)
+    return mascara
+
+def filtrar_caso_memoria(id_caso, conn, filtros=None, columnas=None):
+    # Misma semántica que obtener_datos_caso(id_caso, conn, filtros, columnas) sin volver a consultar la base
+    base = None if columnas is None else list(dict.fromkeys(list(columnas) + COLUMNAS_FILTRO))
+    entrada = obtener_entrada_cache_caso(id_caso, conn, None, base, indexar=True)
+    df = entrada['df']
+    
+    filas = np.flatnonzero(mascara_filtros(entrada['indice'], filtros, len(df)))
+    if len(filas) == len(df):
+        df = df.copy(deep=False)
+    else:
+        df = df.take(filas)
+        # Como en la lectura SQL, las dimensiones decodificadas solo traen las categorías presentes
+        for col in df.select_dtypes('category').columns:
+            df[col] = df[col].cat.remove_unused_categories()
+    return df if columnas is None else df[list(columnas)]
+
+def diagnosticar_consulta_caso(id_caso, conn, columnas=None):
+    # Plan de la lectura que hace filtrar_caso_memoria (sin filtros: se aplican en memoria);
+    # un SCAN recorre la tabla (o el índice) completo
+    base = None if columnas is None else list(dict.fromkeys(list(columnas) + COLUMNAS_FILTRO))
+    query, params, _ = construir_consulta_caso(id_caso, conn, None, base)
+    plan = pd.DataFrame(conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall(),
+                        columns=['id', 'padre', 'no_usado', 'detalle'])[['id', 'padre', 'detalle']]
+    plan['escaneo_completo'] = plan['detalle'].str.startswith('SCAN')
+    return plan
 
 def crear_grafo_coincidencias(df, tolerancia_horas=1):
     df_egresos = df[df['i_e'] == 'Egreso'].copy()
     df_ingresos = df[df['i_e'] == 'Ingreso'].copy()
     
-    df_egresos['fecha_hora'] = pd.to_datetime(
-        df_egresos['fecha'].astype(str) + ' ' + df_egresos['hora'].astype(str), 
-        errors='coerce'
-    )
-    df_ingresos['fecha_hora'] = pd.to_datetime(
-        df_ingresos['fecha'].astype(str) + ' ' + df_ingresos['hora'].astype(str), 
-        errors='coerce'
-    )
-    
     # Eliminar registros donde la conversión falló (datos corruptos en origen)
     df_egresos = df_egresos.dropna(subset=['fecha_hora'])
     df_ingresos = df_ingresos.dropna(subset=['fecha_hora'])
@@ -308,7 +2229,7 @@ def generar_pdf_reporte(id_caso, conn, reportes_incluidos, progress_callback=Non
 
     story.append(Paragraph("RESUMEN EJECUTIVO", heading_style))
     
-    df_caso = obtener_datos_caso(id_caso, conn)
+    df_caso = obtener_datos_caso(id_caso, conn, columnas=['codunicocli_13_enc', 'monto'])
     
     num_involucrados = df_caso['codunicocli_13_enc'].nunique()
     num_transacciones = len(df_caso)